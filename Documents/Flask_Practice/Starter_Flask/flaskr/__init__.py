@@ -8,6 +8,13 @@ def create_app(test_config=None):
     app.config.from_mapping(
         SECRET_KEY='dev',
         MONGO_URI='mongodb://localhost:27017/StarterFlask',
+        MONGO_MAX_POOL_SIZE=100,
+        MONGO_MIN_POOL_SIZE=0,
+        MONGO_WAIT_QUEUE_TIMEOUT_MS=2000,
+        METRICS_FLUSH_SECONDS=5,
+        METRICS_TOKEN=None,
+        QUERY_BUDGET=25,
+        QUERY_REPEAT_LIMIT=5,
     )
 
     if test_config is None:
@@ -32,6 +39,14 @@ def create_app(test_config=None):
     from . import db
     db.init_app(app)
 
+    # Per-route latency histograms, summed across workers at /metrics
+    from . import metrics
+    metrics.init_app(app)
+
+    # Query counts per request, with a warning for likely N+1 patterns
+    from . import query_monitor
+    query_monitor.init_app(app)
+
     from . import auth
     app.register_blueprint(auth.bp)
 
@@ -6,7 +6,7 @@ from werkzeug.security import check_password_hash, generate_password_hash
 from bson.objectid import ObjectId
 from datetime import datetime, timedelta
 import os
-from flaskr.db import get_db
+from flaskr.db import get_db, get_pool_stats
 from flaskr.auth import login_required
 from flaskr.admin_log import log_admin_event, get_log_path, get_user_activity_data
 
@@ -210,6 +210,12 @@ def logs():
     
     return render_template('admin/logs.html', logs=parsed_logs[::-1])  # Reverse to show newest first
 
+@bp.route('/pool-stats')
+@admin_required
+def pool_stats():
+    """Connection pool statistics for this worker process."""
+    return jsonify(get_pool_stats())
+
 @bp.route('/make-admin/<id>', methods=('POST',))
 @admin_required
 def make_admin(id):
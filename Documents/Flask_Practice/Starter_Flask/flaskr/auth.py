@@ -53,6 +53,8 @@ def init_db_indexes(app):
         # Add indexes for interviews
         db['interviews'].create_index([('job_id', 1)])
         db['interviews'].create_index([('student_id', 1)])
+        # Drop request metrics of workers that stopped reporting a day ago
+        db['request_metrics'].create_index([('updated_at', 1)], expireAfterSeconds=24 * 60 * 60)
 
 @bp.route('/')
 def index():
@@ -1,23 +1,168 @@
+import os
+import threading
+import time
+
 import click
 from flask import current_app, g
-from pymongo import MongoClient
+from pymongo import MongoClient, monitoring
+
+
+class PoolStats(monitoring.ConnectionPoolListener):
+    """Collect connection pool counters for the shared MongoClient."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started_at = time.monotonic()
+        self.checked_out = 0
+        self.waiters = 0
+        self.created = 0
+        self.closed = 0
+        self.checkout_failures = 0
+        self.pool_clears = 0
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        with self._lock:
+            self.pool_clears += 1
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        with self._lock:
+            self.created += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.closed += 1
+
+    def connection_check_out_started(self, event):
+        with self._lock:
+            self.waiters += 1
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self.waiters -= 1
+            self.checkout_failures += 1
+
+    def connection_checked_out(self, event):
+        with self._lock:
+            self.waiters -= 1
+            self.checked_out += 1
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.checked_out -= 1
+
+    def snapshot(self):
+        with self._lock:
+            uptime = max(time.monotonic() - self.started_at, 1e-9)
+            return {
+                'checked_out': self.checked_out,
+                'waiters': self.waiters,
+                'created': self.created,
+                'closed': self.closed,
+                'open': self.created - self.closed,
+                'checkout_failures': self.checkout_failures,
+                'pool_clears': self.pool_clears,
+                'creation_rate_per_min': round(self.created / uptime * 60, 3),
+                'uptime_seconds': round(uptime, 1),
+            }
+
+
+class ConnectionManager:
+    """One pooled MongoClient per worker process.
+
+    The client is rebuilt lazily when the process id changes, so an app
+    created before a pre-fork server forks never shares sockets with its
+    parent.
+    """
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._client = None
+        self._pid = None
+        self._stats = None
+        self.uri = None
+        self.options = {}
+        # Extra command/pool listeners for clients built after they are added
+        self.event_listeners = []
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.uri = app.config.get('MONGO_URI', 'mongodb://localhost:27017/StarterFlask')
+        self.options = {
+            'maxPoolSize': app.config.get('MONGO_MAX_POOL_SIZE', 100),
+            'minPoolSize': app.config.get('MONGO_MIN_POOL_SIZE', 0),
+            'waitQueueTimeoutMS': app.config.get('MONGO_WAIT_QUEUE_TIMEOUT_MS', 2000),
+            'maxIdleTimeMS': app.config.get('MONGO_MAX_IDLE_TIME_MS', 300000),
+            'connectTimeoutMS': app.config.get('MONGO_CONNECT_TIMEOUT_MS', 5000),
+            'serverSelectionTimeoutMS': app.config.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', 5000),
+        }
+        app.extensions['mongo'] = self
+
+    @property
+    def client(self):
+        if self._client is None or self._pid != os.getpid():
+            with self._lock:
+                if self._client is None or self._pid != os.getpid():
+                    # Never close a client inherited across fork; the parent still owns its sockets.
+                    self._stats = PoolStats()
+                    self._client = MongoClient(self.uri, event_listeners=[self._stats] + self.event_listeners, **self.options)
+                    self._pid = os.getpid()
+        return self._client
+
+    def get_database(self):
+        return self.client.get_default_database()
+
+    def stats(self):
+        client = self.client
+        data = self._stats.snapshot()
+        data['max_pool_size'] = client.options.pool_options.max_pool_size
+        data['min_pool_size'] = client.options.pool_options.min_pool_size
+        data['wait_queue_timeout'] = client.options.pool_options.wait_queue_timeout
+        data['pid'] = self._pid
+        return data
+
+    def close(self):
+        with self._lock:
+            if self._client is not None and self._pid == os.getpid():
+                self._client.close()
+            self._client = None
+            self._pid = None
+
 
 def get_db():
     if 'db' not in g:
-        mongo_uri = current_app.config.get('MONGO_URI', 'mongodb://localhost:27017/StarterFlask')
-        client = MongoClient(mongo_uri)
-        g.db = client.get_default_database()
+        g.db = current_app.extensions['mongo'].get_database()
     return g.db
 
 def close_db(e=None):
-    db = g.pop('db', None)
-    if db is not None:
-        db.client.close()
+    # The pooled client outlives the request; only drop the per-request handle.
+    g.pop('db', None)
+
+def get_pool_stats():
+    return current_app.extensions['mongo'].stats()
 
 # No init_db needed for MongoDB. Collections are created automatically when data is inserted.
 
-# No CLI init-db command needed for MongoDB.
+@click.command('pool-stats')
+def pool_stats_command():
+    """Print connection pool statistics for this process."""
+    get_db().command('ping')
+    for key, value in get_pool_stats().items():
+        click.echo(f'{key}: {value}')
 
 def init_app(app):
+    ConnectionManager(app)
     app.teardown_appcontext(close_db)
-
+    app.cli.add_command(pool_stats_command)
@@ -1,32 +1,49 @@
 from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session
 from flask_login import LoginManager, login_user, login_required, logout_user, current_user
 from config import Config
-from models import users
+from models import users, appointments, db
 from models.user import User
 from models.appointment import Appointment
 from models.queue import QueueManager
+from models.availability import AvailabilityEngine
+from models.events import EventBus
+from models.versions import ChangeVersions
+from models.queue_board import queue_board
+from models.serialization import parse_fields
+from models.passwords import PasswordHasherBusy, password_hasher
+from mail_worker import MailWorkerPool
+from json_provider import MongoJSONProvider
+from metrics import RequestMetrics
+from query_monitor import QueryMonitor
+from pymongo import monitoring
 from bson import ObjectId
 from datetime import datetime
 from flask import jsonify
 from flask_login import current_user, login_required
 
-# Make sure your MongoDB connection is properly initialized
-# Add this near the top of your app.py
-from pymongo import MongoClient
-
-# MongoDB connection
-client = MongoClient('mongodb://localhost:27017/')
-db = client['healthcare_queue']
 from datetime import datetime, timedelta
-from flask_mail import Mail, Message
-from apscheduler.schedulers.background import BackgroundScheduler
+from flask_mail import Mail
 import json
 import os
-from flask import make_response
+from flask import make_response, Response
 
 # Initialize Flask app
 app = Flask(__name__)
 app.config.from_object(Config)
+# ObjectIds and datetimes in any jsonify() response, orjson when available
+app.json = MongoJSONProvider(app)
+# Query counts per request, with a warning for likely N+1 patterns. Registered
+# before anything below (the mail workers) makes the first query and so
+# creates this process's MongoClient.
+query_monitor = QueryMonitor(app)
+monitoring.register(query_monitor)
+# Latency histograms and status counts per route, summed across workers at /metrics
+request_metrics = RequestMetrics(
+    app,
+    collection=lambda: db.request_metrics,
+    flush_seconds=app.config.get('METRICS_FLUSH_SECONDS', 5),
+    token=app.config.get('METRICS_TOKEN')
+)
 
 # Initialize extensions
 login_manager = LoginManager()
@@ -38,65 +55,14 @@ mail = Mail(app)
 # User loader for Flask-Login
 @login_manager.user_loader
 def load_user(user_id):
-    user = users.find_one({'_id': ObjectId(user_id)})
-    if not user:
-        return None
-    
-    # Create a user-like object that Flask-Login can use
-    class UserObject:
-        def __init__(self, id, email, name, role):
-            self.id = str(id)
-            self.email = email
-            self.name = name
-            self.role = role
-            self.is_authenticated = True
-            self.is_active = True
-            self.is_anonymous = False
-        
-        def get_id(self):
-            return self.id
-    
-    return UserObject(
-        user['_id'], 
-        user['email'], 
-        user['name'],
-        user['role']
-    )
+    # Served from the identity cache; only a miss reaches the database
+    return User.load_identity(user_id)
 
-# Scheduler for background tasks
-scheduler = BackgroundScheduler()
-
-# Scheduler job to send appointment reminders
-def send_reminders():
-    tomorrow = (datetime.utcnow() + timedelta(days=1)).strftime('%Y-%m-%d')
-    
-    # Find appointments for tomorrow
-    upcoming_appointments = list(Appointment.find_by_date(tomorrow, status='scheduled'))
-    
-    for appt in upcoming_appointments:
-        # Get patient info
-        patient = users.find_one({'_id': appt['patient_id']})
-        doctor = users.find_one({'_id': appt['doctor_id']})
-        
-        if patient and 'email' in patient:
-            # Send email reminder
-            msg = Message(
-                subject="Appointment Reminder",
-                recipients=[patient['email']],
-                body=f"Dear {patient['name']},\n\nThis is a reminder for your appointment tomorrow at {appt['time_slot']} with Dr. {doctor['name']}.\n\nPlease arrive 15 minutes early for check-in.\n\nThank you,\nHealthcare Queue Management System"
-            )
-            mail.send(msg)
-            
-            # Update appointment with reminder sent status
-            Appointment.update_status(
-                appt['_id'], 
-                'scheduled', 
-                {'reminder_sent': True}
-            )
-
-# Start scheduler
-scheduler.add_job(send_reminders, 'cron', hour=17)  # Send reminders at 5 PM every day
-scheduler.start()
+# Outbound mail is delivered from the outbox by a small worker pool
+mail_pool = MailWorkerPool(app, mail).start()
+request_metrics.add_source('mail', mail_pool.metrics, counters=('sent', 'retried', 'dead', 'batches'))
+request_metrics.add_source('password_hasher', password_hasher.metrics,
+                           counters=('hashed', 'verified', 'rehashed', 'rejected'))
 
 # Routes
 @app.route('/')
@@ -111,9 +77,15 @@ def login():
         
         user = User.get_by_email(email)
         
-        if user and User.verify_password(user, password):
-            # Create user object for flask-login
-            user_obj = load_user(str(user['_id']))
+        try:
+            verified = user and User.verify_password(user, password)
+        except PasswordHasherBusy:
+            flash('We are handling a lot of sign-ins right now. Please try again in a moment.', 'error')
+            return render_template('login.html'), 503
+        
+        if verified:
+            # Create user object for flask-login from the document we already have
+            user_obj = User.identity_from_document(user)
             login_user(user_obj)
             
             if user['role'] == 'patient':
@@ -143,7 +115,11 @@ def register():
             return render_template('register.html')
         
         # Create new user
-        user_id = User.create_user(email, password, name, role, phone)
+        try:
+            user_id = User.create_user(email, password, name, role, phone)
+        except PasswordHasherBusy:
+            flash('We are handling a lot of sign-ins right now. Please try again in a moment.', 'error')
+            return render_template('register.html'), 503
         
         flash('Registration successful. Please log in.', 'success')
         return redirect(url_for('login'))
@@ -165,40 +141,13 @@ def patient_dashboard():
         return redirect(url_for('index'))
 
     try:
-        # Get today's date
-        today = datetime.now().strftime('%Y-%m-%d')
-        
-        # Get upcoming appointments (scheduled and checked-in)
-        upcoming = Appointment.get_by_patient(
-            current_user.id,
-            status=['scheduled', 'checked-in']
-        )
-        
-        # Separate today's appointments from future appointments
-        todays_appointments = [appt for appt in upcoming if appt['date'] == today]
-        future_appointments = [appt for appt in upcoming if appt['date'] > today]
-        
-        # Get queue status for checked-in appointments
-        for appt in todays_appointments:
-            if appt['status'] == 'checked-in':
-                dept_status = QueueManager.get_department_status(appt['department'])
-                if dept_status:
-                    appt['queue_info'] = {
-                        'position': dept_status['checked_in_count'],
-                        'wait_time': appt['estimated_wait_time'] or dept_status['estimated_wait']
-                    }
-        
-        # Get past appointments
-        past_appointments = Appointment.get_by_patient(
-            current_user.id,
-            status='completed'
-        )
+        # Today's and upcoming appointments with queue info in one pass
+        dashboard = Appointment.get_patient_dashboard(current_user.id)
 
         return render_template(
             'patient/dashboard.html',
-            today_appointments=todays_appointments,
-            upcoming_appointments=future_appointments,
-            past_appointments=past_appointments
+            today_appointments=dashboard['today'],
+            upcoming_appointments=dashboard['upcoming']
         )
         
     except Exception as e:
@@ -222,12 +171,22 @@ def book_appointment_page():
 def get_available_slots():
     doctor_id = request.args.get('doctor_id')
     date = request.args.get('date')
+    start_date = request.args.get('start_date')
+    end_date = request.args.get('end_date')
     
-    if not doctor_id or not date:
+    if not doctor_id or not (date or (start_date and end_date)):
         return jsonify({'error': 'Missing parameters'}), 400
     
-    slots = Appointment.get_available_slots(doctor_id, date)
-    return jsonify({'slots': slots})
+    if date:
+        slots = Appointment.get_available_slots(doctor_id, date)
+        return jsonify({'slots': slots})
+    
+    # Date range lookup is still a single query
+    try:
+        slots_by_date = AvailabilityEngine.free_slots_range(doctor_id, start_date, end_date)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'slots_by_date': slots_by_date})
 
 @app.route('/patient/book_appointment', methods=['POST'])
 @login_required
@@ -274,12 +233,7 @@ def view_appointment(appointment_id):
     # Check queue status if checked in
     queue_info = None
     if appointment['status'] == 'checked-in':
-        dept_status = QueueManager.get_department_status(appointment['department'])
-        if dept_status:
-            queue_info = {
-                'position': dept_status['checked_in_count'],
-                'wait_time': appointment['estimated_wait_time'] or dept_status['estimated_wait']
-            }
+        queue_info = QueueManager.get_queue_info(appointment)
     
     return render_template(
         'patient/view_appointment.html',
@@ -335,6 +289,22 @@ def cancel_appointment(appointment_id):
     flash('Appointment cancelled successfully', 'success')
     return redirect(url_for('patient_dashboard'))
 
+def conditional_json(etag, build, cache_control='private, no-cache'):
+    """Answer a matching If-None-Match with 304, otherwise build the response.
+    
+    The ETag is computed from version counters before the data is read, so
+    a change racing with build() only costs the client one extra refetch.
+    """
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = make_response(build())
+        if response.status_code != 200:
+            return response
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = cache_control
+    return response
+
 # Doctor routes
 # Add this new API endpoint for doctor appointments
 @app.route('/api/patient/appointments')
@@ -344,40 +314,19 @@ def get_patient_appointments():
         return jsonify({'error': 'Unauthorized'}), 403
         
     try:
-        # Get today's date
         today = datetime.now().strftime('%Y-%m-%d')
         
-        # Get all non-completed appointments
-        appointments = Appointment.get_by_patient(
-            current_user.id,
-            status=['scheduled', 'checked-in', 'in-progress']
-        )
-        
-        # Separate today's and upcoming appointments
-        today_appts = []
-        upcoming_appts = []
-        
-        for appt in appointments:
-            # Add queue information for checked-in appointments
-            if appt['status'] == 'checked-in':
-                dept_status = QueueManager.get_department_status(appt['department'])
-                if dept_status:
-                    appt['queue_info'] = {
-                        'position': dept_status['checked_in_count'],
-                        'wait_time': appt['estimated_wait_time'] or dept_status['estimated_wait']
-                    }
-            
-            # Separate appointments by date
-            if appt['date'] == today:
-                today_appts.append(appt)
-            elif appt['date'] > today:
-                upcoming_appts.append(appt)
+        def build():
+            dashboard = Appointment.get_patient_dashboard(current_user.id, today)
+            return jsonify({
+                'today': dashboard['today'],
+                'upcoming': dashboard['upcoming'],
+                'success': True
+            })
         
-        return jsonify({
-            'today': today_appts,
-            'upcoming': upcoming_appts,
-            'success': True
-        })
+        etag = ChangeVersions.etag(today, [f"patient:{current_user.id}"],
+                                   waiting_departments('patient', current_user.id, today))
+        return conditional_json(etag, build)
         
     except Exception as e:
         return jsonify({
@@ -385,6 +334,23 @@ def get_patient_appointments():
             'success': False
         }), 500
 
+def waiting_departments(role, user_id, today):
+    """Departments whose queue the user is in today, as patient or doctor.
+
+    Queue positions and waits on a dashboard only come from these, so its
+    ETag and event stream follow their queues and no others.
+    """
+    return appointments.distinct('department', {
+        f'{role}_id': ObjectId(user_id),
+        'date': today,
+        'status': {'$in': ['checked-in', 'in-progress']}
+    })
+
+def doctor_department(doctor_id):
+    """The department shown on a doctor's dashboard."""
+    doctor = db.users.find_one({'_id': ObjectId(doctor_id)}, {'department': 1})
+    return (doctor or {}).get('department', 'General')
+
 @app.route('/api/doctor/appointments')
 @login_required
 def get_doctor_appointments():
@@ -392,53 +358,22 @@ def get_doctor_appointments():
         return jsonify({'error': 'Unauthorized'}), 403
         
     try:
-        # Get today's date
         today = datetime.now().strftime('%Y-%m-%d')
         
-        # Get all appointments for today
-        todays_appointments = Appointment.get_by_doctor(
-            current_user.id,
-            date=today,
-            status=['scheduled', 'checked-in', 'in-progress', 'completed']
-        )
-        
-        # Get upcoming appointments
-        upcoming_appointments = Appointment.get_by_doctor(
-            current_user.id,
-            status=['scheduled'],
-            future_only=True
-        )
-        # Filter out today's appointments from upcoming
-        upcoming_appointments = [appt for appt in upcoming_appointments if appt['date'] > today]
-        
-        # Get department queue status
-        doctor = db.users.find_one({'_id': ObjectId(current_user.id)})
-        department = doctor.get('department', 'General')
-        dept_status = QueueManager.get_department_status(department)
-        
-        # Update queue information for checked-in appointments
-        for appt in todays_appointments:
-            if appt['status'] == 'checked-in' and dept_status:
-                appt['queue_info'] = {
-                    'position': dept_status['checked_in_count'],
-                    'wait_time': appt['estimated_wait_time'] or dept_status['estimated_wait']
-                }
+        def build():
+            # Appointments, queue positions and metrics in one aggregation
+            dashboard = Appointment.get_doctor_dashboard(current_user.id, today)
+            return jsonify({
+                'today': dashboard['today'],
+                'upcoming': dashboard['upcoming'],
+                'queue_metrics': dashboard['queue_metrics'],
+                'department': doctor_department(current_user.id),
+                'success': True
+            })
         
-        # Calculate queue metrics
-        queue_metrics = {
-            'waiting': len([a for a in todays_appointments if a['status'] == 'checked-in']),
-            'completed': len([a for a in todays_appointments if a['status'] == 'completed']),
-            'scheduled': len([a for a in todays_appointments if a['status'] == 'scheduled']),
-            'in_progress': len([a for a in todays_appointments if a['status'] == 'in-progress'])
-        }
-        
-        return jsonify({
-            'today': todays_appointments,
-            'upcoming': upcoming_appointments,
-            'queue_metrics': queue_metrics,
-            'department': department,
-            'success': True
-        })
+        etag = ChangeVersions.etag(today, [f"doctor:{current_user.id}"],
+                                   waiting_departments('doctor', current_user.id, today))
+        return conditional_json(etag, build)
         
     except Exception as e:
         return jsonify({
@@ -446,6 +381,111 @@ def get_doctor_appointments():
             'success': False
         }), 500
 
+# Default and largest page of appointment history
+HISTORY_PAGE_SIZE = 20
+HISTORY_MAX_PAGE_SIZE = 100
+
+def history_page(fetch):
+    """JSON page of appointment history for the ?cursor=, ?limit= and ?fields= arguments.
+    
+    fetch(limit, cursor, fields) returns up to limit appointments; one extra
+    row is requested to tell whether another page follows.
+    """
+    limit = request.args.get('limit', HISTORY_PAGE_SIZE, type=int)
+    limit = min(max(limit, 1), HISTORY_MAX_PAGE_SIZE)
+    try:
+        rows = fetch(limit + 1, request.args.get('cursor'), parse_fields(request.args.get('fields')))
+    except ValueError as e:
+        return jsonify({'error': str(e), 'success': False}), 400
+    page, next_cursor = Appointment.paginate(rows, limit)
+    return jsonify({
+        'appointments': page,
+        'next_cursor': next_cursor,
+        'success': True
+    })
+
+@app.route('/api/patient/history')
+@login_required
+def get_patient_history():
+    if current_user.role != 'patient':
+        return jsonify({'error': 'Unauthorized'}), 403
+    return history_page(lambda limit, cursor, fields: Appointment.get_by_patient(
+        current_user.id, status='completed', limit=limit, after=cursor, newest_first=True,
+        fields=fields
+    ))
+
+@app.route('/api/doctor/history')
+@login_required
+def get_doctor_history():
+    if current_user.role != 'doctor':
+        return jsonify({'error': 'Unauthorized'}), 403
+    return history_page(lambda limit, cursor, fields: Appointment.get_by_doctor(
+        current_user.id, status='completed', limit=limit, after=cursor, newest_first=True,
+        fields=fields
+    ))
+
+# Seconds between keep-alive comments on an idle event stream
+STREAM_HEARTBEAT_SECONDS = 15
+
+@app.route('/api/stream')
+@login_required
+def event_stream():
+    """Server-Sent Events feed of appointment and queue changes.
+    
+    Dashboards refresh when an event arrives instead of polling; the
+    30 second poll only runs while the stream is disconnected, and a
+    5 minute poll backs the stream up while it is open.
+    
+    Deployment: an open stream holds one request thread (or greenlet)
+    for as long as its tab stays open. Size the server for the number of
+    open dashboards, not the request rate, e.g. gunicorn with gevent or
+    gthread workers and enough threads, and let the proxy keep idle
+    connections open longer than STREAM_HEARTBEAT_SECONDS.
+    """
+    user_id = current_user.id
+    
+    if current_user.role == 'patient':
+        topics = [f'patient:{user_id}']
+        # Follow the queues this patient is already waiting in
+        today = datetime.now().strftime('%Y-%m-%d')
+        waiting_in = waiting_departments('patient', user_id, today)
+        topics += [f'department:{department}' for department in waiting_in]
+    elif current_user.role == 'doctor':
+        topics = [f'doctor:{user_id}']
+    else:
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    is_patient = current_user.role == 'patient'
+    subscription = EventBus.subscribe(topics)
+    
+    def generate():
+        try:
+            yield 'retry: 5000\n\n'
+            while True:
+                event = subscription.get(timeout=STREAM_HEARTBEAT_SECONDS)
+                if event is None:
+                    yield ': keep-alive\n\n'
+                    continue
+                
+                data = dict(event['data'])
+                if is_patient:
+                    if data.get('patient_id') == user_id:
+                        if data.get('status') == 'checked-in':
+                            # Start following the queue this appointment just joined
+                            subscription.topics = subscription.topics | {f"department:{data['department']}"}
+                    else:
+                        # Other patients' queue movement: only say that the queue changed
+                        data = {'department': data.get('department'), 'date': data.get('date')}
+                
+                yield f"event: {event['kind']}\ndata: {app.json.dumps(data)}\n\n"
+        finally:
+            EventBus.unsubscribe(subscription)
+    
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
 @app.route('/doctor/dashboard')
 @login_required
 def doctor_dashboard():
@@ -457,57 +497,16 @@ def doctor_dashboard():
         # Get today's date
         today = datetime.now().strftime('%Y-%m-%d')
         
-        # Get today's appointments
-        todays_appointments = Appointment.get_by_doctor(
-            current_user.id,
-            date=today,
-            status=['scheduled', 'checked-in', 'in-progress']
-        )
-        
-        # Get upcoming appointments (excluding today)
-        upcoming_appointments = Appointment.get_by_doctor(
-            current_user.id,
-            status=['scheduled'],
-            future_only=True
-        )
-        # Filter out today's appointments from upcoming
-        upcoming_appointments = [appt for appt in upcoming_appointments if appt['date'] > today]
-        
-        # Get completed appointments for today
-        completed_today = Appointment.get_by_doctor(
-            current_user.id,
-            date=today,
-            status='completed'
-        )
-        
-        # Calculate queue metrics
-        queue_metrics = {
-            'waiting': len([a for a in todays_appointments if a['status'] == 'checked-in']),
-            'completed': len(completed_today),
-            'scheduled': len([a for a in todays_appointments if a['status'] == 'scheduled']),
-            'in_progress': len([a for a in todays_appointments if a['status'] == 'in-progress'])
-        }
-        
-        # Get department queue status
-        doctor = db.users.find_one({'_id': ObjectId(current_user.id)})
-        department = doctor.get('department', 'General')
-        dept_status = QueueManager.get_department_status(department)
-        
-        # Update wait times for checked-in appointments
-        for appt in todays_appointments:
-            if appt['status'] == 'checked-in' and dept_status:
-                appt['queue_info'] = {
-                    'position': dept_status['checked_in_count'],
-                    'wait_time': appt['estimated_wait_time'] or dept_status['estimated_wait']
-                }
+        # Appointments, queue positions and metrics in one aggregation
+        dashboard = Appointment.get_doctor_dashboard(current_user.id, today)
         
         return render_template(
             'doctor/dashboard.html',
-            today_appointments=todays_appointments,
-            upcoming_appointments=upcoming_appointments,
-            completed_today=completed_today,
-            queue_metrics=queue_metrics,
-            department=department,
+            today_appointments=[a for a in dashboard['today'] if a['status'] != 'completed'],
+            upcoming_appointments=dashboard['upcoming'],
+            completed_today=[a for a in dashboard['today'] if a['status'] == 'completed'],
+            queue_metrics=dashboard['queue_metrics'],
+            department=doctor_department(current_user.id),
             current_date=today
         )
         
@@ -533,12 +532,9 @@ def start_appointment(appointment_id):
         flash('Cannot start - patient is not checked in', 'error')
         return redirect(url_for('doctor_dashboard'))
     
-    # Start the appointment
+    # Start the appointment (queue counters are updated with the status)
     Appointment.update_status(appointment_id, 'in-progress')
     
-    # Update queue status
-    QueueManager.update_department_status(appointment['department'])
-    
     flash('Appointment started', 'success')
     return redirect(url_for('doctor_dashboard'))
 
@@ -560,12 +556,9 @@ def complete_appointment(appointment_id):
         flash('Cannot complete - appointment is not in progress', 'error')
         return redirect(url_for('doctor_dashboard'))
     
-    # Complete the appointment
+    # Complete the appointment (queue counters are updated with the status)
     Appointment.update_status(appointment_id, 'completed')
     
-    # Update queue status
-    QueueManager.update_department_status(appointment['department'])
-    
     flash('Appointment completed', 'success')
     return redirect(url_for('doctor_dashboard'))
 
@@ -588,17 +581,19 @@ def update_availability():
 # Queue Status API
 @app.route('/api/queue_status')
 def get_queue_status():
+    """Public queue board, served from a per-worker snapshot refreshed every few seconds."""
     department = request.args.get('department')
+    board = queue_board.get()
+    cache_control = f"public, max-age={int(queue_board.ttl)}"
     
     if department:
-        status = QueueManager.get_department_status(department)
-        if status:
-            return jsonify(status)
-        return jsonify({'error': 'Department not found'}), 404
+        status = board['departments'].get(department)
+        if not status:
+            return jsonify({'error': 'Department not found'}), 404
+        return conditional_json(board['etags'][department], lambda: jsonify(status), cache_control)
     
     # Get all departments' status
-    all_status = QueueManager.get_department_status()
-    return jsonify(all_status)
+    return conditional_json(board['etag'], lambda: jsonify(board['statuses']), cache_control)
 
 # Error handlers
 @app.errorhandler(404)
@@ -609,12 +604,6 @@ def page_not_found(e):
 def server_error(e):
     return render_template('500.html'), 500
 
-# Cleanup function for the scheduler
-@app.teardown_appcontext
-def shutdown_scheduler(exception=None):
-    if scheduler.running:
-        scheduler.shutdown()
-
 @app.route('/appointment/<appointment_id>/reschedule', methods=['GET', 'POST'])
 @login_required
 def appointment_reschedule(appointment_id):
@@ -695,18 +684,8 @@ def check_time_slots():
                 'success': False
             }), 400
             
-        # Get all time slots
-        all_slots = [
-            "09:00-09:30", "09:30-10:00", "10:00-10:30", "10:30-11:00",
-            "11:00-11:30", "11:30-12:00", "14:00-14:30", "14:30-15:00",
-            "15:00-15:30", "15:30-16:00", "16:00-16:30", "16:30-17:00"
-        ]
-        
-        # Check availability for each slot
-        available_slots = []
-        for slot in all_slots:
-            if Appointment.is_time_slot_available(doctor_id, date, slot, appointment_id):
-                available_slots.append(slot)
+        # One query for the whole day instead of one per slot
+        available_slots = AvailabilityEngine.free_slots(doctor_id, date, appointment_id)
                 
         return jsonify({
             'available_slots': available_slots,
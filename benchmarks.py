@@ -0,0 +1,343 @@
+"""Micro-benchmarks for the hot data paths in models/.
+
+Seeds a dedicated database with a synthetic clinic of 10k to 1M
+appointments, then times the model calls behind the dashboards, booking
+and check-in:
+
+    python benchmarks.py --sizes 10000,100000 --save baseline.json
+    python benchmarks.py --sizes 10000,100000 --baseline baseline.json
+    python benchmarks.py --in-memory --sizes 10000          # mongomock, no mongod needed
+
+The seeded collections are dropped first, so --mongo-uri must name a
+database ending in _bench. With --baseline, any benchmark whose median
+is more than --threshold slower than the baseline is flagged and the exit
+status is 1, so a CI job can fail on it.
+"""
+from datetime import datetime, timedelta
+from models.stats import percentile
+import argparse
+import bcrypt
+import json
+import platform
+import random
+import sys
+import time
+
+DEFAULT_SIZES = '10000,100000,1000000'
+DEFAULT_MONGO_URI = 'mongodb://localhost:27017/healthcare_bench'
+
+DEPARTMENTS = ['General', 'Cardiology', 'Dermatology', 'Orthopedics', 'Pediatrics']
+REASONS = ['Checkup', 'Follow-up', 'Consultation', 'Test results', None]
+
+# Appointments written per insert_many while seeding
+SEED_BATCH_SIZE = 10000
+
+class Dataset:
+    """The users and appointments of one seeded size, plus ids to sample from."""
+
+    def __init__(self, size, seed=0):
+        from models.availability import TIME_SLOTS
+        self.size = size
+        self.random = random.Random(seed)
+        self.slots = TIME_SLOTS
+        self.doctors = max(10, size // 3000)
+        self.patients = max(self.doctors, size // 5)
+        # Every doctor works every slot of every day, mostly in the past
+        per_day = self.doctors * len(TIME_SLOTS)
+        self.days = -(-size // per_day)
+        self.today = datetime.now().strftime('%Y-%m-%d')
+        start = datetime.now() - timedelta(days=int(self.days * 0.85))
+        self.dates = [(start + timedelta(days=n)).strftime('%Y-%m-%d') for n in range(self.days)]
+        self.doctor_ids = []
+        self.patient_ids = []
+        self.scheduled_today = []
+
+    def _status(self, date):
+        if date < self.today:
+            return 'cancelled' if self.random.random() < 0.08 else 'completed'
+        if date == self.today:
+            return self.random.choice(['scheduled', 'scheduled', 'checked-in', 'completed'])
+        return 'cancelled' if self.random.random() < 0.05 else 'scheduled'
+
+    def _appointments(self, doctors, patients):
+        created = datetime.utcnow()
+        count = 0
+        for day, date in enumerate(self.dates):
+            for slot_index, slot in enumerate(self.slots):
+                # A different patient per doctor within one date and slot keeps
+                # the seed clear of the unique slot indexes
+                offset = (day * 7919 + slot_index * 104729) % len(patients)
+                for doctor_index, doctor in enumerate(doctors):
+                    if count == self.size:
+                        return
+                    patient = patients[(doctor_index + offset) % len(patients)]
+                    status = self._status(date)
+                    appointment = {
+                        'patient_id': patient['_id'],
+                        'doctor_id': doctor['_id'],
+                        'department': doctor['specialization'],
+                        'date': date,
+                        'time_slot': slot,
+                        'reason': self.random.choice(REASONS),
+                        'status': status,
+                        'created_at': created,
+                        'priority': 0,
+                        'estimated_wait_time': None,
+                        'actual_start_time': None,
+                        'actual_end_time': None,
+                        'doctor_name': doctor['name'],
+                        'doctor_phone': doctor['phone'],
+                        'patient_name': patient['name'],
+                        'patient_phone': patient['phone']
+                    }
+                    if status != 'cancelled':
+                        appointment['slot_held'] = True
+                    count += 1
+                    yield appointment
+
+    def seed(self, progress=None):
+        """Replace the benchmark collections with this dataset and build the indexes."""
+        from models import db, users, appointments
+        from models.indexes import apply_indexes
+        for name in ('users', 'appointments', 'queue_status', 'versions', 'schema_meta'):
+            db.drop_collection(name)
+
+        # One cheap hash shared by every seeded user; logins are not benchmarked here
+        password = bcrypt.hashpw(b'bench', bcrypt.gensalt(rounds=4))
+        doctors = [{
+            'email': f"bench-doctor-{n}@example.test", 'password': password,
+            'name': f"Bench Doctor {n}", 'role': 'doctor', 'phone': f"555{n:07d}",
+            'specialization': DEPARTMENTS[n % len(DEPARTMENTS)],
+            'created_at': datetime.utcnow(), 'active': True
+        } for n in range(self.doctors)]
+        patients = [{
+            'email': f"bench-patient-{n}@example.test", 'password': password,
+            'name': f"Bench Patient {n}", 'role': 'patient', 'phone': f"556{n:07d}",
+            'created_at': datetime.utcnow(), 'active': True
+        } for n in range(self.patients)]
+        users.insert_many(doctors + patients, ordered=False)
+        self.doctor_ids = [doctor['_id'] for doctor in doctors]
+        self.patient_ids = [patient['_id'] for patient in patients]
+
+        batch = []
+        written = 0
+        for appointment in self._appointments(doctors, patients):
+            batch.append(appointment)
+            if len(batch) == SEED_BATCH_SIZE:
+                appointments.insert_many(batch, ordered=False)
+                written += len(batch)
+                batch = []
+                if progress:
+                    progress(written)
+        if batch:
+            appointments.insert_many(batch, ordered=False)
+        apply_indexes(force=True)
+
+        self.scheduled_today = [appt['_id'] for appt in appointments.find(
+            {'date': self.today, 'status': 'scheduled'}, {'_id': 1}
+        )]
+
+    def doctor(self):
+        return self.random.choice(self.doctor_ids)
+
+    def patient(self):
+        return self.random.choice(self.patient_ids)
+
+    def date(self):
+        return self.random.choice(self.dates)
+
+def _check_in_cycle(dataset):
+    """check_in_patient on today's scheduled appointments, putting each back afterwards."""
+    from models import appointments
+    from models.queue import QueueManager
+    pending = list(dataset.scheduled_today)
+
+    def run():
+        appointment_id = pending.pop() if pending else None
+        if appointment_id is None:
+            return None
+        started = time.perf_counter()
+        QueueManager.check_in_patient(str(appointment_id))
+        elapsed = time.perf_counter() - started
+        # Untimed: make the appointment bookable for the next round
+        appointments.update_one({'_id': appointment_id},
+                                {'$set': {'status': 'scheduled'}, '$unset': {'check_in_time': 1}})
+        pending.insert(0, appointment_id)
+        return elapsed
+    return run
+
+def benchmarks(dataset):
+    """Mapping of benchmark name -> callable timing one call (seconds)."""
+    from models.appointment import Appointment
+    from models.queue import QueueManager
+    from models.user import User
+
+    def timed(fn, make_args):
+        def run():
+            args = make_args()
+            started = time.perf_counter()
+            fn(*args)
+            return time.perf_counter() - started
+        return run
+
+    def history_page(get):
+        return lambda user_id: get(user_id, status='completed', limit=21, newest_first=True)
+
+    return {
+        'get_by_patient': timed(Appointment.get_by_patient, lambda: (dataset.patient(),)),
+        'get_by_patient_history_page': timed(history_page(Appointment.get_by_patient),
+                                             lambda: (dataset.patient(),)),
+        'get_by_doctor_today': timed(Appointment.get_by_doctor, lambda: (dataset.doctor(), dataset.today)),
+        'get_by_doctor_history_page': timed(history_page(Appointment.get_by_doctor),
+                                            lambda: (dataset.doctor(),)),
+        'get_available_slots': timed(Appointment.get_available_slots,
+                                     lambda: (dataset.doctor(), dataset.date())),
+        'is_time_slot_available': timed(Appointment.is_time_slot_available, lambda: (
+            dataset.doctor(), dataset.date(), dataset.random.choice(dataset.slots)
+        )),
+        'update_department_status': timed(QueueManager.update_department_status,
+                                          lambda: (dataset.random.choice(DEPARTMENTS),)),
+        'check_in_patient': _check_in_cycle(dataset),
+        'user_get_by_email': timed(User.get_by_email, lambda: (
+            f"bench-patient-{dataset.random.randrange(dataset.patients)}@example.test",
+        ))
+    }
+
+def measure(run, iterations, warmup):
+    """Time iterations calls of run after warmup untimed calls.
+
+    Returns:
+        dict: n, mean/p50/p95/p99 in milliseconds and calls per second, or
+        None when the benchmark had nothing to run on
+    """
+    for _ in range(warmup):
+        run()
+    samples = [sample for sample in (run() for _ in range(iterations)) if sample is not None]
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    mean = sum(ordered) / len(ordered)
+    return {
+        'n': len(ordered),
+        'mean_ms': round(mean * 1000, 3),
+        'p50_ms': round(percentile(ordered, 0.5) * 1000, 3),
+        'p95_ms': round(percentile(ordered, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(ordered, 0.99) * 1000, 3),
+        'ops_per_sec': round(1 / mean, 1) if mean else None
+    }
+
+def compare(results, baseline, threshold):
+    """Benchmarks whose median got more than threshold (a fraction) slower.
+
+    Returns:
+        list: (size, benchmark, baseline p50 ms, current p50 ms, change)
+    """
+    regressions = []
+    for size, benches in results['results'].items():
+        before_benches = baseline.get('results', {}).get(size, {})
+        for name, current in benches.items():
+            before = before_benches.get(name)
+            if not current or not before or not before['p50_ms']:
+                continue
+            change = (current['p50_ms'] - before['p50_ms']) / before['p50_ms']
+            if change > threshold:
+                regressions.append((size, name, before['p50_ms'], current['p50_ms'], change))
+    return regressions
+
+def format_results(results, baseline=None):
+    lines = []
+    for size, benches in results['results'].items():
+        previous = (baseline or {}).get('results', {}).get(size, {})
+        lines.append(f"\n{int(size):,} appointments")
+        lines.append(f"  {'benchmark':<30} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'ops/s':>9}"
+                     + (f" {'p50 vs base':>12}" if baseline else ''))
+        for name, row in benches.items():
+            if row is None:
+                lines.append(f"  {name:<30} {'(nothing to run on)':>39}")
+                continue
+            line = (f"  {name:<30} {row['p50_ms']:>9} {row['p95_ms']:>9} "
+                    f"{row['p99_ms']:>9} {row['ops_per_sec']:>9}")
+            if baseline:
+                before = (previous.get(name) or {}).get('p50_ms')
+                line += f" {(row['p50_ms'] - before) / before * 100:>+11.1f}%" if before else f" {'new':>12}"
+            lines.append(line)
+    return '\n'.join(lines)
+
+def _connect(mongo_uri, in_memory):
+    # config is already imported (models.stats); clients read it when first used
+    from config import Config
+    Config.MONGO_URI = mongo_uri
+    if in_memory:
+        import mongomock
+        import models
+        models.MongoClient = mongomock.MongoClient
+        from models.events import EventBus
+        # mongomock has no capped collections; a plain one behaves the same here
+        EventBus._collection_ready = True
+    from models import get_database
+    name = get_database().name
+    if not name.endswith('_bench'):
+        raise SystemExit(f"Refusing to drop collections in '{name}'; use a database ending in _bench")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the models package on seeded data')
+    parser.add_argument('--mongo-uri', default=DEFAULT_MONGO_URI, help='database to seed (must end in _bench)')
+    parser.add_argument('--in-memory', action='store_true', help='use mongomock instead of a server')
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help='comma-separated appointment counts')
+    parser.add_argument('--only', help='comma-separated benchmark names to run')
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0, help='random seed for data and sampling')
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='flag a median slower than the baseline by more than this fraction')
+    args = parser.parse_args(argv)
+
+    _connect(args.mongo_uri, args.in_memory)
+    import pymongo
+    only = set(args.only.split(',')) if args.only else None
+    results = {
+        'meta': {
+            'created_at': datetime.utcnow().isoformat(),
+            'python': platform.python_version(),
+            'pymongo': pymongo.version,
+            'backend': 'mongomock' if args.in_memory else 'mongodb',
+            'iterations': args.iterations,
+            'warmup': args.warmup,
+            'seed': args.seed
+        },
+        'results': {}
+    }
+
+    for size in [int(size) for size in args.sizes.split(',')]:
+        dataset = Dataset(size, args.seed)
+        print(f"Seeding {size:,} appointments...", file=sys.stderr)
+        started = time.monotonic()
+        dataset.seed(progress=lambda written: print(f"  {written:,}", file=sys.stderr)
+                     if written % 100000 == 0 else None)
+        print(f"  seeded in {time.monotonic() - started:.1f}s", file=sys.stderr)
+        results['results'][str(size)] = {
+            name: measure(run, args.iterations, args.warmup)
+            for name, run in benchmarks(dataset).items()
+            if only is None or name in only
+        }
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print(format_results(results, baseline))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if baseline:
+        regressions = compare(results, baseline, args.threshold)
+        for size, name, before, current, change in regressions:
+            print(f"REGRESSION {name} at {int(size):,}: p50 {before} ms -> {current} ms ({change:+.0%})")
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,56 @@
+"""Background jobs of the healthcare app, run by scheduler.py.
+
+Each job is named by a textual reference so the MongoDB job store can
+keep it between restarts and any scheduler process can run it.
+"""
+from models.appointment import Appointment
+from models.outbox import Outbox
+from bson import ObjectId
+from datetime import datetime, timedelta
+import time
+
+# Appointments claimed and queued per outbox insert and bulk write
+REMINDER_BATCH_SIZE = 100
+# A run stops after this long; the next scheduled run picks up the rest
+REMINDER_WINDOW_SECONDS = 30 * 60
+
+def _deliverable(appt):
+    # No address, or the patient or doctor account was deleted
+    return bool(appt.get('patient_email') and appt.get('doctor_name'))
+
+# Queue appointment reminders (delivered by the mail worker pool)
+def send_reminders():
+    tomorrow = (datetime.utcnow() + timedelta(days=1)).strftime('%Y-%m-%d')
+    run_id = ObjectId()
+    deadline = time.monotonic() + REMINDER_WINDOW_SECONDS
+    total_queued = 0
+
+    while time.monotonic() < deadline:
+        batch = Appointment.claim_reminder_batch(tomorrow, run_id, REMINDER_BATCH_SIZE)
+        if not batch:
+            break
+
+        queued = [appt for appt in batch if _deliverable(appt)]
+        skipped = [appt['_id'] for appt in batch if not _deliverable(appt)]
+
+        # The dedupe key keeps a re-run from queueing the same reminder twice
+        Outbox.enqueue_many([{
+            'recipients': [appt['patient_email']],
+            'subject': "Appointment Reminder",
+            'body': f"Dear {appt['patient_name']},\n\nThis is a reminder for your appointment tomorrow at {appt['time_slot']} with Dr. {appt['doctor_name']}.\n\nPlease arrive 15 minutes early for check-in.\n\nThank you,\nHealthcare Queue Management System",
+            'kind': 'reminder',
+            'dedupe_key': f"reminder:{appt['_id']}"
+        } for appt in queued])
+
+        Appointment.record_reminders([appt['_id'] for appt in queued], skipped_ids=skipped)
+        total_queued += len(queued)
+
+    return total_queued
+
+# (job id, function reference, trigger, trigger arguments)
+JOBS = [
+    # Send reminders from 5 PM; later runs only pick up what an earlier run did not finish
+    ('send_reminders', 'jobs:send_reminders', 'cron', {'hour': '17-20', 'minute': '*/15'}),
+    # Correct any queue counter drift
+    ('reconcile_queues', 'models.queue:QueueManager.reconcile', 'interval', {'minutes': 5}),
+]
@@ -0,0 +1,53 @@
+"""Flask JSON provider that understands MongoDB documents.
+
+ObjectIds become strings and datetimes ISO 8601 strings wherever they
+appear in a response, so routes can jsonify documents straight from the
+database. orjson is used when installed (``pip install orjson``) unless
+JSON_BACKEND is set to ``json``.
+"""
+from flask.json.provider import DefaultJSONProvider
+from models.serialization import to_json_value
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def _default(value):
+    converted = to_json_value(value)
+    if converted is value:
+        # Decimals, dataclasses and the rest of Flask's defaults
+        return DefaultJSONProvider.default(value)
+    return converted
+
+class MongoJSONProvider(DefaultJSONProvider):
+    def __init__(self, app):
+        super().__init__(app)
+        backend = app.config.get('JSON_BACKEND', 'auto')
+        if backend == 'orjson' and orjson is None:
+            raise RuntimeError("JSON_BACKEND is 'orjson' but orjson is not installed")
+        self.use_orjson = orjson is not None and backend in ('auto', 'orjson')
+
+    @property
+    def backend(self):
+        return 'orjson' if self.use_orjson else 'json'
+
+    def dumps(self, obj, **kwargs):
+        if self.use_orjson:
+            option = orjson.OPT_NON_STR_KEYS
+            if kwargs.get('sort_keys', self.sort_keys):
+                option |= orjson.OPT_SORT_KEYS
+            if kwargs.get('indent'):
+                option |= orjson.OPT_INDENT_2
+            return orjson.dumps(obj, default=_default, option=option).decode()
+
+        kwargs.setdefault('default', _default)
+        kwargs.setdefault('ensure_ascii', self.ensure_ascii)
+        kwargs.setdefault('sort_keys', self.sort_keys)
+        return json.dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        if self.use_orjson and not kwargs:
+            return orjson.loads(s)
+        return json.loads(s, **kwargs)
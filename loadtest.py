@@ -0,0 +1,386 @@
+"""Clinic-day load test for the healthcare app.
+
+Drives the real Flask routes the way one clinic day does:
+- a registration and login burst
+- bookings through /api/check_time_slots and /patient/book_appointment
+- patients checking in
+- doctors starting and completing consultations
+- open dashboard tabs polling every 30 seconds
+
+    python loadtest.py --in-memory                       # app in this process on mongomock
+    python loadtest.py --mongo-uri mongodb://localhost:27017/healthcare_load
+    python loadtest.py --base-url http://localhost:5000  # a running deployment
+    python loadtest.py --in-memory --json today.json --compare last.json
+
+--in-memory needs ``pip install mongomock``. mongomock cannot run the
+doctor dashboard's queue_status join ($lookup with let/pipeline), so there
+doctors see an empty dashboard and never start or complete consultations;
+measure those routes against a real server. Every run registers its own
+users, so pointing it at a shared database only adds data. The report gives
+p50/p95/p99 latency and throughput per route; --json saves it so the next
+release can be compared with --compare.
+"""
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from http.cookiejar import CookieJar
+from models.stats import percentile
+from urllib.parse import urlencode
+import argparse
+import json
+import random
+import re
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+
+DOCTOR_OPTION = re.compile(r'<option value="([0-9a-f]{24})">Dr\. ([^<]*?) \(')
+APPOINTMENT_LOCATION = re.compile(r'/patient/appointment/([0-9a-f]{24})')
+
+class RouteStats:
+    """Latency samples and error counts per route label."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._samples = defaultdict(list)
+        self._errors = defaultdict(int)
+        self._not_modified = defaultdict(int)
+        self._started = time.monotonic()
+
+    def record(self, route, seconds, status):
+        with self._lock:
+            self._samples[route].append(seconds)
+            if status >= 500:
+                self._errors[route] += 1
+            elif status == 304:
+                self._not_modified[route] += 1
+
+    def report(self):
+        """Per-route count, errors, 304s, throughput and latency percentiles (ms)."""
+        elapsed = time.monotonic() - self._started
+        routes = {}
+        with self._lock:
+            for route, samples in self._samples.items():
+                ordered = sorted(samples)
+                routes[route] = {
+                    'count': len(ordered),
+                    'errors': self._errors[route],
+                    'not_modified': self._not_modified[route],
+                    'rps': round(len(ordered) / elapsed, 2) if elapsed else 0,
+                    'p50_ms': round(percentile(ordered, 0.5) * 1000, 1),
+                    'p95_ms': round(percentile(ordered, 0.95) * 1000, 1),
+                    'p99_ms': round(percentile(ordered, 0.99) * 1000, 1)
+                }
+        return {'elapsed_seconds': round(elapsed, 1), 'routes': routes}
+
+class Response:
+    def __init__(self, status, headers, text):
+        self.status = status
+        self.headers = headers
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+class Client:
+    """One browser: a cookie jar plus timing of every request it makes."""
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def request(self, route, method, path, data=None, headers=None):
+        """Send a request without following redirects and record its latency under route."""
+        started = time.monotonic()
+        try:
+            response = self._send(method, path, data, headers or {})
+        except Exception as e:
+            self.stats.record(route, time.monotonic() - started, 599)
+            return Response(599, {}, str(e))
+        self.stats.record(route, time.monotonic() - started, response.status)
+        return response
+
+    def get(self, route, path, params=None, headers=None):
+        if params:
+            path = f"{path}?{urlencode(params)}"
+        return self.request(route, 'GET', path, headers=headers)
+
+    def post(self, route, path, data=None):
+        return self.request(route, 'POST', path, data=data or {})
+
+class AppClient(Client):
+    """Calls the app in this process through Flask's test client."""
+
+    def __init__(self, stats, app):
+        super().__init__(stats)
+        self._client = app.test_client()
+
+    def _send(self, method, path, data, headers):
+        response = self._client.open(path, method=method, data=data, headers=headers)
+        return Response(response.status_code, response.headers, response.get_data(as_text=True))
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+class HTTPClient(Client):
+    """Calls a running deployment over HTTP."""
+
+    def __init__(self, stats, base_url, timeout=30):
+        super().__init__(stats)
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self._opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(CookieJar()), _NoRedirect()
+        )
+
+    def _send(self, method, path, data, headers):
+        body = urlencode(data).encode() if data is not None else None
+        request = urllib.request.Request(self.base_url + path, data=body, headers=headers, method=method)
+        try:
+            with self._opener.open(request, timeout=self.timeout) as response:
+                return Response(response.status, response.headers, response.read().decode())
+        except urllib.error.HTTPError as e:
+            # Redirects and error statuses arrive here because redirects are not followed
+            return Response(e.code, e.headers, e.read().decode(errors='replace'))
+
+class ClinicDay:
+    """One simulated clinic day, compressed into --duration seconds."""
+
+    def __init__(self, make_client, options):
+        self.make_client = make_client
+        self.options = options
+        self.run_id = uuid.uuid4().hex[:8]
+        self.today = datetime.now().strftime('%Y-%m-%d')
+        self.stop = threading.Event()
+        self.booked = []  # (patient client, appointment id, doctor id)
+        self.completed = set()
+        self.failed_bookings = 0
+        self._lock = threading.Lock()
+
+    def _account(self, role, n):
+        return {
+            'email': f"load-{self.run_id}-{role}-{n}@example.test",
+            'password': f"load-{self.run_id}",
+            'name': f"Load {role.title()} {self.run_id}-{n}",
+            'role': role,
+            'phone': f"555{n:07d}"
+        }
+
+    def sign_in(self, account, register=True):
+        """Register (optionally) and log in a fresh browser, retrying while auth is busy."""
+        client = self.make_client()
+        for attempt in range(5):
+            if register:
+                response = client.post('POST /register', '/register', account)
+                if response.status == 503:
+                    time.sleep(0.5 * (attempt + 1))
+                    continue
+                register = False
+            response = client.post('POST /login', '/login', {
+                'email': account['email'], 'password': account['password']
+            })
+            if response.status == 302:
+                return client
+            time.sleep(0.5 * (attempt + 1))
+        return None
+
+    def _doctors(self, client):
+        page = client.get('GET /patient/book_appointment', '/patient/book_appointment').text
+        prefix = f"Load Doctor {self.run_id}-"
+        return [doctor_id for doctor_id, name in DOCTOR_OPTION.findall(page) if name.startswith(prefix)]
+
+    def book(self, client, doctor_ids):
+        """Find a free slot with one of the doctors and book it; give up after a few conflicts."""
+        for _ in range(3):
+            doctor_id = random.choice(doctor_ids)
+            response = client.get('GET /api/check_time_slots', '/api/check_time_slots',
+                                  {'doctor_id': doctor_id, 'date': self.today})
+            slots = response.json().get('available_slots', []) if response.status == 200 else []
+            if not slots:
+                continue
+            response = client.post('POST /patient/book_appointment', '/patient/book_appointment', {
+                'doctor_id': doctor_id,
+                'date': self.today,
+                'time_slot': random.choice(slots),
+                'reason': 'Load test'
+            })
+            match = APPOINTMENT_LOCATION.search(response.headers.get('Location', '') or '')
+            if match:
+                with self._lock:
+                    self.booked.append((client, match.group(1), doctor_id))
+                return True
+        with self._lock:
+            self.failed_bookings += 1
+        return False
+
+    def poll_tab(self, account, role):
+        """A dashboard left open: refresh every poll interval with the last ETag."""
+        client = self.sign_in(account, register=False)
+        if client is None:
+            return
+        path = f"/api/{role}/appointments"
+        etags = {}
+        while not self.stop.wait(random.uniform(0.5, 1.5) * self.options.poll_interval):
+            for route, url in ((f"GET {path}", path), ('GET /api/queue_status', '/api/queue_status')):
+                headers = {'If-None-Match': etags[url]} if url in etags else None
+                response = client.get(route, url, headers=headers)
+                if response.headers.get('ETag'):
+                    etags[url] = response.headers['ETag']
+
+    def check_in(self, client, appointment_id):
+        # Patients arrive over the first half of the session
+        if self.stop.wait(random.uniform(0, self.options.duration / 2)):
+            return
+        path = f"/patient/check_in/{appointment_id}"
+        client.post('POST /patient/check_in/<id>', path)
+        client.get('GET /patient/appointment/<id>', f"/patient/appointment/{appointment_id}")
+
+    def consult(self, client, doctor_id):
+        """Take checked-in patients one at a time until the day ends."""
+        mine = {appointment_id for _, appointment_id, booked_doctor in self.booked if booked_doctor == doctor_id}
+        while not self.stop.is_set() and not mine <= self.completed:
+            response = client.get('GET /api/doctor/appointments', '/api/doctor/appointments')
+            waiting = []
+            if response.status == 200:
+                waiting = [appt['_id'] for appt in response.json().get('today', [])
+                           if appt.get('status') == 'checked-in' and appt['_id'] in mine]
+            if not waiting:
+                self.stop.wait(1.0)
+                continue
+            appointment_id = waiting[0]
+            client.post('POST /doctor/start_appointment/<id>', f"/doctor/start_appointment/{appointment_id}")
+            self.stop.wait(self.options.consult_seconds)
+            client.post('POST /doctor/complete_appointment/<id>', f"/doctor/complete_appointment/{appointment_id}")
+            with self._lock:
+                self.completed.add(appointment_id)
+
+    def run(self):
+        options = self.options
+        doctor_accounts = [self._account('doctor', n) for n in range(options.doctors)]
+        patient_accounts = [self._account('patient', n) for n in range(options.patients)]
+
+        with ThreadPoolExecutor(max_workers=options.concurrency) as pool:
+            # Opening time: everyone registers and logs in at once
+            doctors = list(pool.map(self.sign_in, doctor_accounts))
+            patients = list(pool.map(self.sign_in, patient_accounts))
+            signed_in = [client for client in patients if client]
+            doctor_ids = self._doctors(signed_in[0]) if signed_in else []
+            if not doctor_ids:
+                raise RuntimeError('No doctors registered; is the app reachable?')
+            list(pool.map(lambda client: self.book(client, doctor_ids), signed_in))
+
+        accounts = patient_accounts + doctor_accounts
+        threads = [threading.Thread(target=self.poll_tab, args=(
+            accounts[n % len(accounts)], 'patient' if n % len(accounts) < len(patient_accounts) else 'doctor'
+        )) for n in range(options.tabs)]
+        threads += [threading.Thread(target=self.check_in, args=(client, appointment_id))
+                    for client, appointment_id, _ in self.booked]
+        threads += [threading.Thread(target=self.consult, args=(doctor, doctor_id))
+                    for doctor_id, doctor in self._doctor_clients(doctors)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        deadline = time.monotonic() + options.duration
+        while time.monotonic() < deadline and len(self.completed) < len(self.booked):
+            time.sleep(0.5)
+        self.stop.set()
+        for thread in threads:
+            thread.join(options.poll_interval * 2 + options.consult_seconds + 5)
+
+        return {
+            'patients': options.patients,
+            'doctors': options.doctors,
+            'tabs': options.tabs,
+            'booked': len(self.booked),
+            'failed_bookings': self.failed_bookings,
+            'completed': len(self.completed)
+        }
+
+    def _doctor_clients(self, doctors):
+        """Pair each signed-in doctor's browser with their user id, read off their own bookings.
+
+        Doctors nobody booked have nothing to consult on and are left out.
+        """
+        for client in doctors:
+            if client is None:
+                continue
+            response = client.get('GET /api/doctor/appointments', '/api/doctor/appointments')
+            today = response.json().get('today', []) if response.status == 200 else []
+            if today:
+                yield today[0]['doctor_id'], client
+
+def format_report(report, baseline=None):
+    """Text table of a report, with p95 change against a previous report when given."""
+    lines = [f"{'route':<42} {'count':>7} {'err':>5} {'304':>6} {'req/s':>8} "
+             f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}" + (f" {'p95 vs last':>12}" if baseline else '')]
+    previous = (baseline or {}).get('routes', {})
+    for route, row in sorted(report['routes'].items()):
+        line = (f"{route:<42} {row['count']:>7} {row['errors']:>5} {row['not_modified']:>6} "
+                f"{row['rps']:>8} {row['p50_ms']:>8} {row['p95_ms']:>8} {row['p99_ms']:>8}")
+        if baseline:
+            before = previous.get(route, {}).get('p95_ms')
+            line += f" {(row['p95_ms'] - before) / before * 100:>+11.1f}%" if before else f" {'new':>12}"
+        lines.append(line)
+    return '\n'.join(lines)
+
+def _in_process_app(mongo_uri=None, in_memory=False):
+    if mongo_uri:
+        # config is already imported (models.stats); clients read it when first used
+        from config import Config
+        Config.MONGO_URI = mongo_uri
+    if in_memory:
+        import mongomock
+        import models
+        models.MongoClient = mongomock.MongoClient
+        from models.events import EventBus
+        # mongomock has no capped collections; a plain one behaves the same here
+        EventBus._collection_ready = True
+    import app as healthcare
+    healthcare.app.config['TESTING'] = True
+    return healthcare.app
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Clinic-day load test')
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--in-memory', action='store_true', help='run the app in-process on mongomock')
+    target.add_argument('--mongo-uri', help='run the app in-process against this database')
+    target.add_argument('--base-url', help='drive a running deployment over HTTP')
+    parser.add_argument('--patients', type=int, default=100)
+    parser.add_argument('--doctors', type=int, default=10)
+    parser.add_argument('--tabs', type=int, default=50, help='dashboard tabs left open and polling')
+    parser.add_argument('--poll-interval', type=float, default=30, help='seconds between dashboard polls')
+    parser.add_argument('--consult-seconds', type=float, default=0.5, help='time between start and complete')
+    parser.add_argument('--duration', type=float, default=120, help='longest the clinic session may run')
+    parser.add_argument('--concurrency', type=int, default=20, help='browsers acting at once during the burst')
+    parser.add_argument('--json', help='write the report to this file')
+    parser.add_argument('--compare', help='report saved by an earlier run to compare against')
+    args = parser.parse_args(argv)
+
+    stats = RouteStats()
+    if args.base_url:
+        make_client = lambda: HTTPClient(stats, args.base_url)
+    else:
+        app = _in_process_app(args.mongo_uri, args.in_memory)
+        make_client = lambda: AppClient(stats, app)
+
+    summary = ClinicDay(make_client, args).run()
+    report = stats.report()
+    report['summary'] = summary
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print(format_report(report, baseline))
+    print(', '.join(f"{key}: {value}" for key, value in summary.items()))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
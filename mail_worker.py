@@ -0,0 +1,280 @@
+"""Background delivery of the mail outbox.
+
+MailWorkerPool drains models.outbox in batches on a small, fixed set of
+threads, so a slow SMTP server never blocks a request or the scheduler.
+LocalSMTPServer is an in-process SMTP stand-in for tests and benchmarks:
+
+    python mail_worker.py --smtp-stub --port 1025
+"""
+from datetime import datetime
+from flask_mail import BadHeaderError, Message
+from models.outbox import Outbox
+from models.stats import percentile, recent_samples
+import argparse
+import os
+import smtplib
+import socket
+import socketserver
+import threading
+import time
+import uuid
+
+class MailWorkerPool:
+    """A bounded pool of threads delivering queued mail in batches."""
+
+    def __init__(self, app, mail, workers=None, batch_size=None, idle_seconds=2.0):
+        self.app = app
+        self.mail = mail
+        self.workers = workers or app.config.get('MAIL_WORKERS', 2)
+        self.batch_size = batch_size or app.config.get('MAIL_BATCH_SIZE', 50)
+        self.max_attempts = app.config.get('MAIL_MAX_ATTEMPTS', 5)
+        self.retry_base_seconds = app.config.get('MAIL_RETRY_BASE_SECONDS', 30)
+        self.idle_seconds = idle_seconds
+        self._start_lock = threading.Lock()
+        self._running = False
+        self._pid = None
+        self._reset()
+        app.before_request(self._ensure_started)
+
+    def _reset(self):
+        self._threads = []
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._started_at = None
+        self._counters = {'sent': 0, 'retried': 0, 'dead': 0, 'batches': 0}
+        # Recent samples for percentiles: queue latency and SMTP time per message
+        self._queue_latency = recent_samples()
+        self._send_time = recent_samples()
+
+    def start(self):
+        """Start the worker threads in this process.
+
+        Threads do not survive a fork, so a worker forked from a process
+        that already started the pool (gunicorn --preload) starts its own
+        on its first request.
+        """
+        with self._start_lock:
+            self._running = True
+            if self._pid == os.getpid():
+                return self
+            # Threads and numbers inherited across a fork belong to the parent
+            self._reset()
+            self._pid = os.getpid()
+            self._started_at = time.monotonic()
+            prefix = f"{socket.gethostname()}:{os.getpid()}"
+            for n in range(self.workers):
+                thread = threading.Thread(
+                    target=self._run, args=(f"{prefix}:{n}:{uuid.uuid4().hex[:6]}",),
+                    name=f'mail-worker-{n}', daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+        return self
+
+    def _ensure_started(self):
+        if self._running and self._pid != os.getpid():
+            self.start()
+
+    def stop(self, timeout=10):
+        self._running = False
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+        self._pid = None
+
+    def _run(self, worker_id):
+        while not self._stop.is_set():
+            try:
+                delivered = self.process_batch(worker_id)
+            except Exception as e:
+                print(f"Mail worker {worker_id} error: {str(e)}")
+                delivered = 0
+            if not delivered:
+                self._stop.wait(self.idle_seconds)
+
+    def process_batch(self, worker_id):
+        """Claim and deliver one batch over a single SMTP session.
+
+        Returns:
+            int: Number of messages claimed
+        """
+        batch = Outbox.claim_batch(worker_id, self.batch_size)
+        if not batch:
+            return 0
+
+        sent, failed, permanent = [], [], []
+        # What the messages left unhandled below are retried with
+        error = 'Delivery interrupted'
+        try:
+            with self.app.app_context(), self.mail.connect() as conn:
+                for position, message in enumerate(batch):
+                    started = time.monotonic()
+                    try:
+                        conn.send(Message(
+                            subject=message['subject'],
+                            recipients=message['recipients'],
+                            body=message['body']
+                        ))
+                    except (smtplib.SMTPRecipientsRefused, BadHeaderError) as e:
+                        # Refused recipients, or a header that can never be sent
+                        permanent.append((message, e))
+                        continue
+                    except (smtplib.SMTPDataError, smtplib.SMTPSenderRefused) as e:
+                        # Rejected this message only; the session is still usable
+                        failed.append((message, e))
+                        continue
+                    except (smtplib.SMTPException, OSError) as e:
+                        # The session is unusable; retry the rest of the batch later
+                        error = e
+                        break
+                    except Exception as e:
+                        # Flask-Mail refused the message (e.g. no sender configured);
+                        # retried with backoff and dead-lettered after max_attempts
+                        failed.append((message, e))
+                        continue
+                    sent.append(message)
+                    self._observe(message, time.monotonic() - started)
+        except (smtplib.SMTPException, OSError) as e:
+            error = e
+        finally:
+            # Release every claimed message, even when an unexpected error escapes
+            handled = {m['_id'] for m in sent} | {m['_id'] for m, _ in failed + permanent}
+            failed.extend((m, error) for m in batch if m['_id'] not in handled)
+            dead = Outbox.record_batch(
+                sent, failed, self.max_attempts, self.retry_base_seconds, permanent
+            )
+            with self._lock:
+                self._counters['batches'] += 1
+                self._counters['sent'] += len(sent)
+                self._counters['retried'] += len(failed) + len(permanent) - dead
+                self._counters['dead'] += dead
+        return len(batch)
+
+    def _observe(self, message, send_seconds):
+        created_at = message.get('created_at')
+        latency = (datetime.utcnow() - created_at).total_seconds() if created_at else None
+        with self._lock:
+            self._send_time.append(send_seconds)
+            if latency is not None:
+                self._queue_latency.append(latency)
+
+    def metrics(self):
+        """Throughput and latency of this process's workers."""
+        with self._lock:
+            counters = dict(self._counters)
+            queue_latency = list(self._queue_latency)
+            send_time = list(self._send_time)
+        uptime = time.monotonic() - self._started_at if self._started_at else 0
+        counters.update({
+            'workers': len(self._threads),
+            'uptime_seconds': round(uptime, 1),
+            'sent_per_second': round(counters['sent'] / uptime, 3) if uptime else 0,
+            'queue_latency_p50': percentile(queue_latency, 0.5),
+            'queue_latency_p95': percentile(queue_latency, 0.95),
+            'send_time_p50': percentile(send_time, 0.5),
+            'send_time_p95': percentile(send_time, 0.95)
+        })
+        return counters
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    def _reply(self, line):
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self):
+        server = self.server.owner
+        self._reply('220 localhost LocalSMTPServer ready')
+        envelope = {'from': None, 'to': []}
+        while True:
+            raw = self.rfile.readline()
+            if not raw:
+                return
+            command = raw.decode(errors='replace').strip()
+            verb = command[:4].upper()
+            if verb in ('HELO', 'EHLO'):
+                self._reply('250 localhost')
+            elif verb == 'MAIL':
+                envelope = {'from': command[10:].strip(' <>'), 'to': []}
+                self._reply('250 OK')
+            elif verb == 'RCPT':
+                envelope['to'].append(command[8:].strip(' <>'))
+                self._reply('250 OK')
+            elif verb == 'DATA':
+                self._reply('354 End data with <CR><LF>.<CR><LF>')
+                lines = []
+                while True:
+                    line = self.rfile.readline()
+                    if not line or line in (b'.\r\n', b'.\n'):
+                        break
+                    lines.append(line.decode(errors='replace'))
+                self._reply(server._accept(envelope, ''.join(lines)))
+                envelope = {'from': None, 'to': []}
+            elif verb in ('RSET', 'NOOP'):
+                self._reply('250 OK')
+            elif verb == 'QUIT':
+                self._reply('221 Bye')
+                return
+            else:
+                self._reply('502 Command not implemented')
+
+class LocalSMTPServer:
+    """A minimal SMTP server that keeps received messages in memory.
+
+    Point MAIL_SERVER/MAIL_PORT at it with MAIL_USE_TLS off. ``latency``
+    delays every message to imitate a slow relay and ``fail_every`` makes
+    every n-th message fail with a temporary 451 to exercise retries.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, fail_every=0):
+        self.latency = latency
+        self.fail_every = fail_every
+        self.messages = []
+        self._count = 0
+        self._lock = threading.Lock()
+        self._server = socketserver.ThreadingTCPServer((host, port), _SMTPHandler)
+        self._server.daemon_threads = True
+        self._server.owner = self
+        self._thread = None
+
+    @property
+    def address(self):
+        return self._server.server_address
+
+    def _accept(self, envelope, data):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self._count += 1
+            if self.fail_every and self._count % self.fail_every == 0:
+                return '451 Temporary failure, try again later'
+            self.messages.append({'from': envelope['from'], 'to': envelope['to'], 'data': data})
+        return '250 OK: queued'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Outbox delivery tools')
+    parser.add_argument('--smtp-stub', action='store_true', help='run the local SMTP stand-in')
+    parser.add_argument('--port', type=int, default=1025)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds to delay each message')
+    parser.add_argument('--fail-every', type=int, default=0, help='fail every n-th message with 451')
+    args = parser.parse_args()
+
+    if args.smtp_stub:
+        stub = LocalSMTPServer(port=args.port, latency=args.latency, fail_every=args.fail_every).start()
+        print(f"Local SMTP stand-in listening on {stub.address[0]}:{stub.address[1]}")
+        try:
+            while True:
+                time.sleep(5)
+                print(f"{len(stub.messages)} messages received")
+        except KeyboardInterrupt:
+            stub.stop()
+    else:
+        parser.print_help()
@@ -0,0 +1,334 @@
+"""Per-route request metrics in the Prometheus text format.
+
+Every request is timed into a fixed-bucket histogram labelled by method
+and route rule (``/patient/appointment/<appointment_id>``, never the raw
+URL), with counters per status code and a gauge of requests in flight.
+
+Each worker process keeps its own numbers and upserts a snapshot of them
+into a MongoDB collection every few seconds. GET /metrics sums the
+snapshots of every worker, on every host, so a scrape that lands on any
+one worker sees the whole deployment.
+
+A worker that stops reporting for retire_seconds (stopped, restarted or
+crashed) is retired: its final counts are added to a permanent
+``retired`` totals document and its snapshot no longer counts. The summed
+counters therefore never go down, which would read to Prometheus' rate()
+as a counter reset and a false spike.
+
+Other per-process components (the mail workers, the password hasher)
+report through add_source. Their numbers travel in the same snapshot and
+are served per worker, labelled ``worker``, rather than summed, since
+percentiles cannot be added up.
+"""
+from flask import Response, g, request
+from datetime import datetime, timedelta
+from pymongo.errors import DuplicateKeyError
+import hashlib
+import os
+import socket
+import threading
+import time
+import uuid
+
+# Upper bounds (seconds) of the latency histogram buckets; +Inf is implied
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(**labels):
+    return '{' + ','.join(f'{key}="{_label(value)}"' for key, value in labels.items()) + '}'
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+# _id of the document holding the counts of retired workers
+RETIRED_ID = 'retired'
+
+def _series_key(*labels):
+    # Route rules may contain dots, which update paths cannot
+    return hashlib.sha1('\0'.join(str(label) for label in labels).encode()).hexdigest()[:16]
+
+class RequestMetrics:
+    """Latency histograms and status counters for one Flask app.
+
+    Args:
+        collection: Callable returning the MongoDB collection the worker
+            snapshots are written to
+        flush_seconds: How often each worker writes its snapshot
+        token: Optional bearer token required to read /metrics
+        retire_seconds: Silence after which a worker's counts are retired
+    """
+
+    def __init__(self, app=None, collection=None, flush_seconds=5.0, token=None, retire_seconds=300):
+        self.collection = collection
+        self.flush_seconds = flush_seconds
+        self.token = token
+        self.retire_seconds = retire_seconds
+        self._lock = threading.Lock()
+        self._pid = None
+        self._sources = {}
+        self._reset()
+        if app is not None:
+            self.init_app(app)
+
+    def _reset(self):
+        self._in_flight = 0
+        self._flusher = None
+        self._restart_counts()
+
+    def _restart_counts(self):
+        # (method, endpoint) -> [bucket counts..., +Inf count], plus sums
+        self._buckets = {}
+        self._sums = {}
+        self._statuses = {}
+        self._worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+    def init_app(self, app):
+        app.before_request(self._before)
+        app.after_request(self._after)
+        app.teardown_request(self._teardown)
+        app.add_url_rule('/metrics', 'metrics', self.endpoint)
+        app.extensions['request_metrics'] = self
+
+    def add_source(self, prefix, collect, counters=()):
+        """Serve another component's numbers with this worker's snapshot.
+
+        Args:
+            prefix: Metric name prefix, e.g. ``mail``
+            collect: Callable returning a flat dict of numbers; None
+                values (e.g. a percentile with no samples yet) are skipped
+            counters: Keys that only ever grow; they get a ``_total`` suffix
+        """
+        self._sources[prefix] = (collect, set(counters))
+
+    def _source_samples(self):
+        samples = []
+        for prefix, (collect, counters) in self._sources.items():
+            try:
+                values = collect()
+            except Exception as e:
+                print(f"Error collecting {prefix} metrics: {str(e)}")
+                continue
+            for key, value in values.items():
+                if not isinstance(value, (int, float)):
+                    continue
+                if key in counters:
+                    samples.append({'name': f"{prefix}_{key}_total", 'type': 'counter', 'value': value})
+                else:
+                    samples.append({'name': f"{prefix}_{key}", 'type': 'gauge', 'value': value})
+        return samples
+
+    def _ensure_worker(self):
+        """Start afresh in a forked worker and keep a flusher thread running."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._reset()
+            self._pid = os.getpid()
+            self._flusher = threading.Thread(target=self._flush_loop, name='metrics-flush', daemon=True)
+            self._flusher.start()
+
+    def _before(self):
+        self._ensure_worker()
+        g._metrics_started = time.perf_counter()
+        with self._lock:
+            self._in_flight += 1
+
+    def _after(self, response):
+        self._observe(response.status_code)
+        return response
+
+    def _teardown(self, error=None):
+        if getattr(g, '_metrics_started', None) is None:
+            return
+        if not getattr(g, '_metrics_observed', False):
+            # An unhandled exception skipped after_request
+            self._observe(500)
+        with self._lock:
+            self._in_flight -= 1
+        g._metrics_started = None
+
+    def _observe(self, status):
+        started = getattr(g, '_metrics_started', None)
+        if started is None or getattr(g, '_metrics_observed', False):
+            return
+        g._metrics_observed = True
+        # Time to the response object; a streamed body is not included
+        elapsed = time.perf_counter() - started
+        rule = request.url_rule
+        key = (request.method, rule.rule if rule is not None else '<unmatched>')
+        with self._lock:
+            buckets = self._buckets.get(key)
+            if buckets is None:
+                buckets = self._buckets[key] = [0] * (len(LATENCY_BUCKETS) + 1)
+                self._sums[key] = 0.0
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if elapsed <= bound:
+                    buckets[index] += 1
+                    break
+            else:
+                buckets[-1] += 1
+            self._sums[key] += elapsed
+            status_key = key + (status,)
+            self._statuses[status_key] = self._statuses.get(status_key, 0) + 1
+
+    def snapshot(self):
+        """This worker's numbers as a document for the snapshot collection."""
+        samples = self._source_samples()
+        with self._lock:
+            return {
+                '_id': self._worker_id,
+                'updated_at': datetime.utcnow(),
+                'in_flight': self._in_flight,
+                'samples': samples,
+                'series': [
+                    {'method': method, 'endpoint': endpoint, 'buckets': list(buckets),
+                     'sum': self._sums[(method, endpoint)]}
+                    for (method, endpoint), buckets in self._buckets.items()
+                ],
+                'statuses': [
+                    {'method': method, 'endpoint': endpoint, 'status': status, 'count': count}
+                    for (method, endpoint, status), count in self._statuses.items()
+                ]
+            }
+
+    def flush(self):
+        snapshot = self.snapshot()
+        try:
+            self.collection().replace_one({'_id': snapshot['_id'], 'retired': {'$ne': True}},
+                                          snapshot, upsert=True)
+        except DuplicateKeyError:
+            # Silent for so long that its counts were retired; they must not
+            # be counted twice, so carry on as a new worker from zero
+            with self._lock:
+                self._restart_counts()
+
+    def retire_silent_workers(self):
+        """Fold the counts of workers silent for retire_seconds into the retired totals."""
+        collection = self.collection()
+        silent_since = datetime.utcnow() - timedelta(seconds=self.retire_seconds)
+        stale = {'_id': {'$ne': RETIRED_ID}, 'retired': {'$ne': True}, 'updated_at': {'$lt': silent_since}}
+        for candidate in collection.find(stale, {'_id': 1}):
+            # Only one collector claims each snapshot, and its worker can no longer change it
+            snapshot = collection.find_one_and_update(dict(stale, _id=candidate['_id']), {'$set': {'retired': True}})
+            if snapshot is None:
+                continue
+            inc, labels = {}, {}
+            for series in snapshot.get('series', []):
+                key = _series_key(series['method'], series['endpoint'])
+                labels[f"series.{key}.method"] = series['method']
+                labels[f"series.{key}.endpoint"] = series['endpoint']
+                for index, count in enumerate(series['buckets']):
+                    inc[f"series.{key}.b{index}"] = count
+                inc[f"series.{key}.sum"] = series['sum']
+            for row in snapshot.get('statuses', []):
+                key = _series_key(row['method'], row['endpoint'], row['status'])
+                labels[f"statuses.{key}.method"] = row['method']
+                labels[f"statuses.{key}.endpoint"] = row['endpoint']
+                labels[f"statuses.{key}.status"] = row['status']
+                inc[f"statuses.{key}.count"] = row['count']
+            if inc:
+                # No updated_at, so the snapshot TTL index never removes it
+                collection.update_one({'_id': RETIRED_ID}, {'$inc': inc, '$set': labels}, upsert=True)
+
+    def _flush_loop(self):
+        pid = os.getpid()
+        while self._pid == pid:
+            time.sleep(self.flush_seconds)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Error flushing request metrics: {str(e)}")
+
+    def collect(self):
+        """Sum the snapshots of every worker.
+
+        Returns:
+            dict: buckets and sums per (method, endpoint), counts per
+            (method, endpoint, status), requests in flight, live workers
+            and the add_source samples of each live worker
+        """
+        self.flush()
+        self.retire_silent_workers()
+        live_after = datetime.utcnow() - timedelta(seconds=3 * self.flush_seconds)
+        buckets, sums, statuses, samples = {}, {}, {}, {}
+        in_flight = workers = 0
+        for snapshot in self.collection().find():
+            if snapshot['_id'] == RETIRED_ID:
+                for series in snapshot.get('series', {}).values():
+                    key = (series['method'], series['endpoint'])
+                    total = buckets.setdefault(key, [0] * (len(LATENCY_BUCKETS) + 1))
+                    for index in range(len(total)):
+                        total[index] += series.get(f"b{index}", 0)
+                    sums[key] = sums.get(key, 0.0) + series.get('sum', 0.0)
+                for row in snapshot.get('statuses', {}).values():
+                    key = (row['method'], row['endpoint'], row['status'])
+                    statuses[key] = statuses.get(key, 0) + row['count']
+                continue
+            if snapshot.get('retired'):
+                # Already counted in the retired totals
+                continue
+            if snapshot['updated_at'] >= live_after:
+                # Only workers that are still reporting have requests in flight
+                in_flight += snapshot.get('in_flight', 0)
+                workers += 1
+                for row in snapshot.get('samples', []):
+                    samples.setdefault((row['name'], row['type']), []).append((snapshot['_id'], row['value']))
+            for series in snapshot.get('series', []):
+                key = (series['method'], series['endpoint'])
+                total = buckets.setdefault(key, [0] * (len(LATENCY_BUCKETS) + 1))
+                for index, count in enumerate(series['buckets'][:len(total)]):
+                    total[index] += count
+                sums[key] = sums.get(key, 0.0) + series['sum']
+            for row in snapshot.get('statuses', []):
+                key = (row['method'], row['endpoint'], row['status'])
+                statuses[key] = statuses.get(key, 0) + row['count']
+        return {'buckets': buckets, 'sums': sums, 'statuses': statuses,
+                'in_flight': in_flight, 'workers': workers, 'samples': samples}
+
+    @staticmethod
+    def render(collected):
+        """Prometheus text exposition of collect()'s result."""
+        lines = [
+            '# HELP http_request_duration_seconds Time to produce a response, by route.',
+            '# TYPE http_request_duration_seconds histogram'
+        ]
+        for (method, endpoint), counts in sorted(collected['buckets'].items()):
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), counts):
+                cumulative += count
+                le = bound if bound == '+Inf' else _number(bound)
+                lines.append(f"http_request_duration_seconds_bucket"
+                             f"{_labels(method=method, endpoint=endpoint, le=le)} {cumulative}")
+            labels = _labels(method=method, endpoint=endpoint)
+            lines.append(f"http_request_duration_seconds_sum{labels} {_number(collected['sums'][(method, endpoint)])}")
+            lines.append(f"http_request_duration_seconds_count{labels} {cumulative}")
+
+        lines += [
+            '# HELP http_requests_total Requests answered, by route and status code.',
+            '# TYPE http_requests_total counter'
+        ]
+        for (method, endpoint, status), count in sorted(collected['statuses'].items()):
+            lines.append(f"http_requests_total{_labels(method=method, endpoint=endpoint, status=status)} {count}")
+
+        lines += [
+            '# HELP http_requests_in_flight Requests being handled right now.',
+            '# TYPE http_requests_in_flight gauge',
+            f"http_requests_in_flight {collected['in_flight']}",
+            '# HELP app_workers Worker processes that reported in the last few seconds.',
+            '# TYPE app_workers gauge',
+            f"app_workers {collected['workers']}"
+        ]
+        for (name, kind), values in sorted(collected.get('samples', {}).items()):
+            lines.append(f"# TYPE {name} {kind}")
+            for worker, value in sorted(values):
+                lines.append(f"{name}{_labels(worker=worker)} {_number(value)}")
+        return '\n'.join(lines) + '\n'
+
+    def endpoint(self):
+        if self.token and request.headers.get('Authorization') != f"Bearer {self.token}":
+            return Response('Unauthorized\n', status=401, mimetype='text/plain')
+        return Response(self.render(self.collect()), mimetype='text/plain; version=0.0.4')
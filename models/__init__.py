@@ -1,12 +1,103 @@
 from pymongo import MongoClient
 from config import Config
+import os
+import threading
+
+def _write_concern(value):
+    # '1', '2', ... are node counts; anything else is a tag such as 'majority'
+    return int(value) if str(value).isdigit() else value
+
+def create_client(uri=None, **overrides):
+    """Build a MongoClient with the pool, timeout and concern settings from Config.
+
+    Returns a client that does not connect until first used, so it is safe
+    to create before a pre-fork server forks.
+    """
+    options = {
+        'maxPoolSize': Config.MONGO_MAX_POOL_SIZE,
+        'minPoolSize': Config.MONGO_MIN_POOL_SIZE,
+        'maxIdleTimeMS': Config.MONGO_MAX_IDLE_TIME_MS,
+        'waitQueueTimeoutMS': Config.MONGO_WAIT_QUEUE_TIMEOUT_MS,
+        'connectTimeoutMS': Config.MONGO_CONNECT_TIMEOUT_MS,
+        'serverSelectionTimeoutMS': Config.MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        'socketTimeoutMS': Config.MONGO_SOCKET_TIMEOUT_MS,
+        'w': _write_concern(Config.MONGO_WRITE_CONCERN),
+        'readConcernLevel': Config.MONGO_READ_CONCERN,
+        'readPreference': Config.MONGO_READ_PREFERENCE,
+        'connect': False
+    }
+    options.update(overrides)
+    return MongoClient(uri or Config.MONGO_URI, **options)
+
+class _Connection:
+    """The MongoClient of the current process.
+
+    Rebuilt lazily when the process id changes, so a worker forked from a
+    process that already used the client never shares its sockets or
+    monitor threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self.client = None
+        self.database = None
+        self.collections = {}
+
+    def current(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    # Never close a client inherited across fork; the parent still owns it
+                    self.client = create_client()
+                    self.database = self.client.get_database()
+                    self.collections = {}
+                    self._pid = os.getpid()
+        return self
+
+    def collection(self, name):
+        connection = self.current()
+        collection = connection.collections.get(name)
+        if collection is None:
+            collection = connection.collections[name] = connection.database[name]
+        return collection
+
+_connection = _Connection()
+
+def get_client():
+    """The shared MongoClient of this process."""
+    return _connection.current().client
+
+def get_database():
+    """The application database named in MONGO_URI."""
+    return _connection.current().database
+
+class _ProcessLocal:
+    """Module-level handle that resolves to this process's database object on every use."""
+
+    def __init__(self, resolve):
+        self._resolve = resolve
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+    def __getitem__(self, name):
+        return self._resolve()[name]
+
+    def __repr__(self):
+        return f"<process-local {self._resolve()!r}>"
+
+def _collection(name):
+    return _ProcessLocal(lambda: _connection.collection(name))
 
 # Connect to MongoDB
-client = MongoClient(Config.MONGO_URI)
-db = client.get_database()
+db = _ProcessLocal(get_database)
 
 # Define collections
-users = db.users
-appointments = db.appointments
-queue_status = db.queue_status
-departments = db.departments
+users = _collection('users')
+appointments = _collection('appointments')
+queue_status = _collection('queue_status')
+departments = _collection('departments')
+doctor_stats = _collection('doctor_stats')
+outbox = _collection('outbox')
+versions = _collection('versions')
\ No newline at end of file
@@ -1,9 +1,169 @@
 from . import appointments, users
+from .availability import AvailabilityEngine
+from .events import EventBus
+from .queue import QueueManager
+from .serialization import APPOINTMENT_SCHEMA
+from .versions import ChangeVersions
 from datetime import datetime, timedelta
 from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import ReturnDocument, UpdateMany, UpdateOne
+from pymongo.errors import DuplicateKeyError
+import base64
+import binascii
 import re
 
+# Appointment states a patient still has to attend
+ACTIVE_STATUSES = ['scheduled', 'checked-in', 'in-progress']
+
+# Fields returned by the patient and doctor list views
+PATIENT_LIST_FIELDS = (
+    '_id', 'patient_id', 'doctor_id', 'department', 'date', 'time_slot', 'reason', 'status',
+    'created_at', 'priority', 'estimated_wait_time', 'actual_start_time', 'actual_end_time',
+    'doctor_name'
+)
+DOCTOR_LIST_FIELDS = PATIENT_LIST_FIELDS[:-1] + ('patient_name', 'patient_phone')
+
+# Keys of the (date, time_slot, _id) order that pagination cursors encode
+CURSOR_FIELDS = ('_id', 'date', 'time_slot')
+
+# User profile fields copied onto appointments as doctor_<field> / patient_<field>
+SNAPSHOT_FIELDS = ('name', 'phone')
+
 class Appointment:
+    @staticmethod
+    def _list_projection(list_fields, fields=None):
+        """$project for a list view, narrowed to the requested fields.
+
+        The cursor keys are always kept so a narrowed page can still be continued.
+        """
+        if fields:
+            list_fields = [f for f in list_fields if f in fields or f in CURSOR_FIELDS]
+        return {field: 1 for field in list_fields}
+
+    @staticmethod
+    def _slot_conflict(error):
+        """Turn a violation of the slot unique indexes into the user-facing message."""
+        details = getattr(error, 'details', None) or {}
+        if 'patient_id' in details.get('keyPattern', {}) or 'patient_slot_unique' in str(error):
+            return ValueError("You already have an appointment scheduled at this time")
+        return ValueError("This time slot is already booked for the selected doctor")
+
+    @staticmethod
+    def _publish_change(appointment, previous_status=None):
+        """Tell open dashboards about a booking or an edit that kept the status.
+
+        Status changes are published by QueueManager.record_transition.
+        """
+        EventBus.publish('appointment', EventBus.topics_for(appointment), {
+            'appointment_id': str(appointment['_id']),
+            'patient_id': str(appointment.get('patient_id')),
+            'doctor_id': str(appointment.get('doctor_id')),
+            'department': appointment.get('department'),
+            'date': appointment.get('date'),
+            'time_slot': appointment.get('time_slot'),
+            'previous_status': previous_status,
+            'status': appointment.get('status')
+        })
+
+    @staticmethod
+    def encode_cursor(appt):
+        """Opaque cursor pointing just past an appointment in (date, time_slot, _id) order."""
+        raw = f"{appt['date']}|{appt['time_slot']}|{appt['_id']}"
+        return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+    @staticmethod
+    def decode_cursor(cursor):
+        """Inverse of encode_cursor; raises ValueError for a malformed cursor."""
+        try:
+            raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+            date, time_slot, appointment_id = raw.split('|')
+            return date, time_slot, ObjectId(appointment_id)
+        except (ValueError, binascii.Error, InvalidId, UnicodeDecodeError):
+            raise ValueError('Invalid cursor')
+
+    @staticmethod
+    def _keyset(query, after, newest_first):
+        """Restrict a query to the appointments after a cursor."""
+        if not after:
+            return query
+        date, time_slot, appointment_id = Appointment.decode_cursor(after)
+        op = '$lt' if newest_first else '$gt'
+        return {'$and': [query, {'$or': [
+            {'date': {op: date}},
+            {'date': date, 'time_slot': {op: time_slot}},
+            {'date': date, 'time_slot': time_slot, '_id': {op: appointment_id}}
+        ]}]}
+
+    @staticmethod
+    def _page_stages(limit, newest_first):
+        direction = -1 if newest_first else 1
+        stages = [{'$sort': {'date': direction, 'time_slot': direction, '_id': direction}}]
+        if limit:
+            stages.append({'$limit': limit})
+        return stages
+
+    @staticmethod
+    def paginate(appointment_list, limit):
+        """Split rows fetched with limit + 1 into a page and the cursor of the next one.
+
+        Returns:
+            tuple: (appointments, next cursor or None on the last page)
+        """
+        if len(appointment_list) <= limit:
+            return appointment_list, None
+        page = appointment_list[:limit]
+        return page, Appointment.encode_cursor(page[-1])
+
+    @staticmethod
+    def snapshot(role, user):
+        """The display fields of a doctor or patient as stored on their appointments."""
+        return {f'{role}_{field}': (user or {}).get(field) for field in SNAPSHOT_FIELDS}
+
+    @staticmethod
+    def sync_user_snapshot(user_id, profile):
+        """Copy changed profile fields onto the user's appointments.
+
+        Args:
+            user_id: The ID of the doctor or patient
+            profile: The profile fields that were just updated
+        """
+        changed = [field for field in SNAPSHOT_FIELDS if field in profile]
+        if not changed:
+            return
+        if isinstance(user_id, str):
+            user_id = ObjectId(user_id)
+        appointments.bulk_write([
+            UpdateMany(
+                {f'{role}_id': user_id},
+                {'$set': {f'{role}_{field}': profile[field] for field in changed}}
+            )
+            for role in ('doctor', 'patient')
+        ], ordered=False)
+        
+        # Dashboards of everyone with a current appointment with this user now differ
+        today = datetime.now().strftime('%Y-%m-%d')
+        ChangeVersions.bump(
+            [f"patient:{patient_id}" for patient_id in
+             appointments.distinct('patient_id', {'doctor_id': user_id, 'date': {'$gte': today}})] +
+            [f"doctor:{doctor_id}" for doctor_id in
+             appointments.distinct('doctor_id', {'patient_id': user_id, 'date': {'$gte': today}})]
+        )
+
+    @staticmethod
+    def _with_slot_hold(update, status):
+        """Add the slot_held change implied by a status to an update document.
+
+        Only appointments carrying slot_held are covered by the partial unique
+        indexes on (doctor_id | patient_id, date, time_slot), so cancelling
+        releases the slot for someone else.
+        """
+        if status == 'cancelled':
+            update.setdefault('$unset', {})['slot_held'] = ''
+        else:
+            update['$set']['slot_held'] = True
+        return update
+
     @staticmethod
     def create(patient_id, doctor_id, date, time_slot, reason=None):
         """Create a new appointment."""
@@ -13,33 +173,15 @@ class Appointment:
         if isinstance(doctor_id, str):
             doctor_id = ObjectId(doctor_id)
             
-        # Get doctor info for department
-        doctor = users.find_one({'_id': doctor_id})
+        # Doctor (for the department) and patient display fields in one read
+        people = {user['_id']: user for user in users.find(
+            {'_id': {'$in': [doctor_id, patient_id]}},
+            {'name': 1, 'phone': 1, 'specialization': 1}
+        )}
+        doctor = people.get(doctor_id)
         if not doctor:
             raise ValueError("Doctor not found")
             
-        # Check if the time slot is already taken for this doctor
-        existing_appointment = appointments.find_one({
-            'doctor_id': doctor_id,
-            'date': date,
-            'time_slot': time_slot,
-            'status': {'$ne': 'cancelled'}
-        })
-        
-        if existing_appointment:
-            raise ValueError("This time slot is already booked for the selected doctor")
-        
-        # Check if patient already has an appointment at this time
-        patient_appointment = appointments.find_one({
-            'patient_id': patient_id,
-            'date': date,
-            'time_slot': time_slot,
-            'status': {'$ne': 'cancelled'}
-        })
-        
-        if patient_appointment:
-            raise ValueError("You already have an appointment scheduled at this time")
-            
         appointment = {
             'patient_id': patient_id,
             'doctor_id': doctor_id,
@@ -52,22 +194,47 @@ class Appointment:
             'priority': 0,  # 0=normal, 1=priority, 2=emergency
             'estimated_wait_time': None,
             'actual_start_time': None,
-            'actual_end_time': None
+            'actual_end_time': None,
+            'slot_held': True  # Checked by the unique slot indexes, see _with_slot_hold
         }
+        # Names and phones for list views, kept current by sync_user_snapshot
+        appointment.update(Appointment.snapshot('doctor', doctor))
+        appointment.update(Appointment.snapshot('patient', people.get(patient_id)))
         
+        # The partial unique indexes reject a second live booking of the same
+        # doctor or patient slot atomically, even between concurrent requests
         try:
             result = appointments.insert_one(appointment)
-            # Return both the appointment ID and the created appointment data
-            return {
-                'appointment_id': result.inserted_id,
-                'appointment': appointment
-            }
+        except DuplicateKeyError as e:
+            raise Appointment._slot_conflict(e)
         except Exception as e:
             raise ValueError("Failed to create appointment. Please try again.")
+        
+        # The booking exists from here on; neither step may report it as failed
+        ChangeVersions.bump(ChangeVersions.keys_for(appointment))
+        Appointment._publish_change(appointment)
+        # Return both the appointment ID and the created appointment data
+        return {
+            'appointment_id': result.inserted_id,
+            'appointment': appointment
+        }
     
     @staticmethod
-    def get_by_patient(patient_id, status=None):
-        """Get appointments for a patient."""
+    def get_by_patient(patient_id, status=None, limit=None, after=None, newest_first=False,
+                       fields=None):
+        """Get appointments for a patient.
+        
+        Args:
+            patient_id: The ID of the patient
+            status (str or list, optional): Filter appointments by status
+            limit (int, optional): Maximum number of appointments to return
+            after (str, optional): Cursor from encode_cursor to continue after
+            newest_first (bool, optional): Page backwards from the latest appointment
+            fields (set, optional): Only return these fields (plus the cursor keys)
+        
+        Returns:
+            list: A list of appointments in (date, time_slot, _id) order
+        """
         # Convert string ID to ObjectId if needed
         if isinstance(patient_id, str):
             patient_id = ObjectId(patient_id)
@@ -82,72 +249,155 @@ class Appointment:
             else:
                 query['status'] = status
         
-        # Join with doctor information and format the output
+        # Doctor name comes from the snapshot on the appointment
+        projection = Appointment._list_projection(PATIENT_LIST_FIELDS, fields)
         pipeline = [
-            {'$match': query},
-            {'$lookup': {
-                'from': 'users',
-                'localField': 'doctor_id',
-                'foreignField': '_id',
-                'as': 'doctor'
-            }},
-            {'$unwind': '$doctor'},
-            {'$project': {
-                '_id': 1,
-                'patient_id': 1,
-                'doctor_id': 1,
-                'department': 1,
-                'date': 1,
-                'time_slot': 1,
-                'reason': 1,
-                'status': 1,
-                'created_at': 1,
-                'priority': 1,
-                'estimated_wait_time': 1,
-                'actual_start_time': 1,
-                'actual_end_time': 1,
-                'doctor_name': '$doctor.name'
-            }},
-            {'$sort': {'date': 1, 'time_slot': 1}}
+            {'$match': Appointment._keyset(query, after, newest_first)}
+        ] + Appointment._page_stages(limit, newest_first) + [
+            {'$project': projection}
         ]
         
         try:
-            appointments_list = list(appointments.aggregate(pipeline))
-            
             # Format the dates and times for consistent output
-            for appt in appointments_list:
-                # Convert ObjectIds to strings
-                appt['_id'] = str(appt['_id'])
-                appt['patient_id'] = str(appt['patient_id'])
-                appt['doctor_id'] = str(appt['doctor_id'])
-                
-                # Ensure date is in YYYY-MM-DD format
-                if isinstance(appt['date'], datetime):
-                    appt['date'] = appt['date'].strftime('%Y-%m-%d')
-                    
-                # Format timestamps if they exist
-                if appt.get('created_at'):
-                    appt['created_at'] = appt['created_at'].isoformat()
-                if appt.get('actual_start_time'):
-                    appt['actual_start_time'] = appt['actual_start_time'].isoformat()
-                if appt.get('actual_end_time'):
-                    appt['actual_end_time'] = appt['actual_end_time'].isoformat()
-                    
-                # Ensure priority is an integer
-                appt['priority'] = int(appt.get('priority', 0))
-                
-                # Set default values for null fields
-                appt['estimated_wait_time'] = appt.get('estimated_wait_time')
-                appt['reason'] = appt.get('reason', '')
-                
-            return appointments_list
+            return APPOINTMENT_SCHEMA.dump_many(
+                appointments.aggregate(pipeline), projection if fields else None
+            )
             
         except Exception as e:
             print(f"Error fetching appointments: {str(e)}")
             return []
     
     @staticmethod
-    def get_by_doctor(doctor_id, date=None, status=None, future_only=False):
+    def get_patient_dashboard(patient_id, today=None):
+        """Today's and upcoming appointments of a patient in one query.
+
+        A single $facet aggregation splits the patient's appointments into
+        the dashboard sections; checked-in appointments get their queue_info
+        from one batched queue status read. History is paged separately with
+        get_by_patient so the dashboard cost does not grow with it.
+
+        Args:
+            patient_id: The ID of the patient
+            today: The current day (YYYY-MM-DD), defaults to today
+
+        Returns:
+            dict: today and upcoming lists, formatted like get_by_patient
+        """
+        if isinstance(patient_id, str):
+            patient_id = ObjectId(patient_id)
+        today = today or datetime.now().strftime('%Y-%m-%d')
+        
+        pipeline = [
+            {'$match': {
+                'patient_id': patient_id,
+                'date': {'$gte': today},
+                'status': {'$in': ACTIVE_STATUSES}
+            }},
+            {'$facet': {
+                'today': [
+                    {'$match': {'date': today}},
+                    {'$sort': {'time_slot': 1}}
+                ],
+                'upcoming': [
+                    {'$match': {'date': {'$gt': today}}},
+                    {'$sort': {'date': 1, 'time_slot': 1}}
+                ]
+            }}
+        ]
+        
+        try:
+            sections = next(appointments.aggregate(pipeline), {})
+        except Exception as e:
+            print(f"Error fetching patient dashboard: {str(e)}")
+            sections = {}
+        
+        dashboard = {}
+        for section in ('today', 'upcoming'):
+            dashboard[section] = APPOINTMENT_SCHEMA.dump_many(sections.get(section, []))
+        QueueManager.attach_queue_info(dashboard['today'])
+        return dashboard
+    
+    @staticmethod
+    def get_doctor_dashboard(doctor_id, today=None):
+        """Everything the doctor dashboard shows, from one aggregation.
+
+        The $facet splits the doctor's appointments from today onwards into
+        today's list and upcoming bookings, counts today's statuses in the
+        database and joins the queue status of every department someone is
+        waiting in, so a poll costs one round trip.
+
+        Args:
+            doctor_id: The ID of the doctor
+            today: The current day (YYYY-MM-DD), defaults to today
+
+        Returns:
+            dict: today (all of today's appointments), upcoming, queue_metrics
+        """
+        if isinstance(doctor_id, str):
+            doctor_id = ObjectId(doctor_id)
+        today = today or datetime.now().strftime('%Y-%m-%d')
+        
+        pipeline = [
+            {'$match': {
+                'doctor_id': doctor_id,
+                'date': {'$gte': today},
+                'status': {'$in': ACTIVE_STATUSES + ['completed']}
+            }},
+            {'$facet': {
+                'today': [
+                    {'$match': {'date': today}},
+                    {'$sort': {'time_slot': 1}}
+                ],
+                'upcoming': [
+                    {'$match': {'date': {'$gt': today}, 'status': 'scheduled'}},
+                    {'$sort': {'date': 1, 'time_slot': 1}}
+                ],
+                'counts': [
+                    {'$match': {'date': today}},
+                    {'$group': {'_id': '$status', 'count': {'$sum': 1}}}
+                ],
+                'queue_status': [
+                    {'$match': {'date': today, 'status': 'checked-in'}},
+                    {'$group': {'_id': '$department'}},
+                    # Only today's document of each department, via the (department, date) index
+                    {'$lookup': {
+                        'from': 'queue_status',
+                        'let': {'department': '$_id'},
+                        'pipeline': [
+                            {'$match': {'date': today, '$expr': {'$eq': ['$department', '$$department']}}},
+                            {'$limit': 1}
+                        ],
+                        'as': 'status'
+                    }},
+                    {'$unwind': '$status'},
+                    {'$replaceRoot': {'newRoot': '$status'}}
+                ]
+            }}
+        ]
+        
+        try:
+            sections = next(appointments.aggregate(pipeline), {})
+        except Exception as e:
+            print(f"Error fetching doctor dashboard: {str(e)}")
+            sections = {}
+        
+        counts = {row['_id']: row['count'] for row in sections.get('counts', [])}
+        todays = APPOINTMENT_SCHEMA.dump_many(sections.get('today', []))
+        QueueManager.attach_queue_info(todays, sections.get('queue_status', []))
+        return {
+            'today': todays,
+            'upcoming': APPOINTMENT_SCHEMA.dump_many(sections.get('upcoming', [])),
+            'queue_metrics': {
+                'waiting': counts.get('checked-in', 0),
+                'completed': counts.get('completed', 0),
+                'scheduled': counts.get('scheduled', 0),
+                'in_progress': counts.get('in-progress', 0)
+            }
+        }
+    
+    @staticmethod
+    def get_by_doctor(doctor_id, date=None, status=None, future_only=False,
+                      limit=None, after=None, newest_first=False, fields=None):
         """Get appointments for a doctor.
         
         Args:
@@ -155,9 +405,13 @@ class Appointment:
             date (str, optional): Filter appointments by date (YYYY-MM-DD)
             status (str or list, optional): Filter appointments by status
             future_only (bool, optional): If True, only return appointments with future dates
+            limit (int, optional): Maximum number of appointments to return
+            after (str, optional): Cursor from encode_cursor to continue after
+            newest_first (bool, optional): Page backwards from the latest appointment
+            fields (set, optional): Only return these fields (plus the cursor keys)
         
         Returns:
-            list: A list of appointments matching the criteria
+            list: A list of appointments in (date, time_slot, _id) order
         """
         # Convert string ID to ObjectId if needed
         if isinstance(doctor_id, str):
@@ -180,66 +434,19 @@ class Appointment:
             else:
                 query['status'] = status
         
-        # Join with patient information and format the output
+        # Patient name and phone come from the snapshot on the appointment
+        projection = Appointment._list_projection(DOCTOR_LIST_FIELDS, fields)
         pipeline = [
-            {'$match': query},
-            {'$lookup': {
-                'from': 'users',
-                'localField': 'patient_id',
-                'foreignField': '_id',
-                'as': 'patient'
-            }},
-            {'$unwind': '$patient'},
-            {'$project': {
-                '_id': 1,
-                'patient_id': 1,
-                'doctor_id': 1,
-                'department': 1,
-                'date': 1,
-                'time_slot': 1,
-                'reason': 1,
-                'status': 1,
-                'created_at': 1,
-                'priority': 1,
-                'estimated_wait_time': 1,
-                'actual_start_time': 1,
-                'actual_end_time': 1,
-                'patient_name': '$patient.name',
-                'patient_phone': '$patient.phone'
-            }},
-            {'$sort': {'date': 1, 'time_slot': 1}}
+            {'$match': Appointment._keyset(query, after, newest_first)}
+        ] + Appointment._page_stages(limit, newest_first) + [
+            {'$project': projection}
         ]
         
         try:
-            appointments_list = list(appointments.aggregate(pipeline))
-            
             # Format the dates and times for consistent output
-            for appt in appointments_list:
-                # Convert ObjectIds to strings
-                appt['_id'] = str(appt['_id'])
-                appt['patient_id'] = str(appt['patient_id'])
-                appt['doctor_id'] = str(appt['doctor_id'])
-                
-                # Ensure date is in YYYY-MM-DD format
-                if isinstance(appt['date'], datetime):
-                    appt['date'] = appt['date'].strftime('%Y-%m-%d')
-                    
-                # Format timestamps if they exist
-                if appt.get('created_at'):
-                    appt['created_at'] = appt['created_at'].isoformat()
-                if appt.get('actual_start_time'):
-                    appt['actual_start_time'] = appt['actual_start_time'].isoformat()
-                if appt.get('actual_end_time'):
-                    appt['actual_end_time'] = appt['actual_end_time'].isoformat()
-                    
-                # Ensure priority is an integer
-                appt['priority'] = int(appt.get('priority', 0))
-                
-                # Set default values for null fields
-                appt['estimated_wait_time'] = appt.get('estimated_wait_time')
-                appt['reason'] = appt.get('reason', '')
-                
-            return appointments_list
+            return APPOINTMENT_SCHEMA.dump_many(
+                appointments.aggregate(pipeline), projection if fields else None
+            )
             
         except Exception as e:
             print(f"Error fetching doctor appointments: {str(e)}")
@@ -249,83 +456,145 @@ class Appointment:
     def update_status(appointment_id, status, additional_data=None):
         """Update appointment status."""
         update_data = {'status': status}
+        now = datetime.utcnow()
         
         if status == 'checked-in':
-            update_data['check_in_time'] = datetime.utcnow()
+            update_data['check_in_time'] = now
         elif status == 'in-progress':
-            update_data['actual_start_time'] = datetime.utcnow()
+            update_data['actual_start_time'] = now
         elif status == 'completed':
-            update_data['actual_end_time'] = datetime.utcnow()
+            update_data['actual_end_time'] = now
             
         if additional_data:
             update_data.update(additional_data)
             
-        appointments.update_one(
-            {'_id': ObjectId(appointment_id)},
-            {'$set': update_data}
-        )
+        try:
+            previous = appointments.find_one_and_update(
+                {'_id': ObjectId(appointment_id)},
+                Appointment._with_slot_hold({'$set': update_data}, status),
+                return_document=ReturnDocument.BEFORE
+            )
+        except DuplicateKeyError as e:
+            # Only reachable when reviving a cancelled appointment whose slot was rebooked
+            raise Appointment._slot_conflict(e)
+        
+        # Keep the department queue counters and wait estimates in step with the change
+        QueueManager.record_transition(previous, status, now)
     
     @staticmethod
-    def get_available_slots(doctor_id, date):
+    def get_available_slots(doctor_id, date, exclude_appointment_id=None):
         """Get available time slots for a doctor on a specific date."""
-        # Define default working hours (8 AM to 5 PM)
-        work_start = 8  # 8 AM
-        work_end = 17   # 5 PM
-        slot_duration = 30  # 30 minutes
+        return AvailabilityEngine.free_slots(doctor_id, date, exclude_appointment_id)
+    
+    @staticmethod
+    def claim_reminder_batch(date, run_id, limit=100, claim_ttl_minutes=30):
+        """Claim the next batch of appointments that still need a reminder.
         
-        # Generate all possible time slots
-        all_slots = []
-        current_time = work_start
-        while current_time < work_end:
-            hour = current_time
-            minutes = (current_time - hour) * 60
-            slot_time = f"{int(hour):02d}:{int(minutes):02d}"
-            all_slots.append(slot_time)
-            current_time += slot_duration/60
+        Claims stop two reminder runs from mailing the same patient, and a
+        claim left behind by a crashed run expires after claim_ttl_minutes.
         
-        # Get booked slots
-        booked_appointments = appointments.find({
-            'doctor_id': ObjectId(doctor_id),
+        Args:
+            date: The appointment date (YYYY-MM-DD format)
+            run_id: Identifier of the reminder run taking the claim
+            limit: Maximum number of appointments to claim
+            claim_ttl_minutes: Age after which another run's claim is ignored
+            
+        Returns:
+            list: Claimed appointments with patient and doctor name and email;
+            the fields of a patient or doctor that no longer exists are missing
+        """
+        now = datetime.utcnow()
+        pending = {
             'date': date,
-            'status': {'$nin': ['cancelled']}
-        })
+            'status': 'scheduled',
+            'reminder_sent': {'$ne': True},
+            'reminder_skipped': {'$ne': True},
+            '$or': [
+                {'reminder_claimed_at': None},
+                {'reminder_claimed_at': {'$lt': now - timedelta(minutes=claim_ttl_minutes)}}
+            ]
+        }
+        candidate_ids = [appt['_id'] for appt in
+                         appointments.find(pending, {'_id': 1}).sort('_id', 1).limit(limit)]
+        if not candidate_ids:
+            return []
         
-        booked_slots = [appointment['time_slot'] for appointment in booked_appointments]
+        appointments.update_many(
+            dict(pending, _id={'$in': candidate_ids}),
+            {'$set': {'reminder_claim': run_id, 'reminder_claimed_at': now}}
+        )
         
-        # Return available slots
-        return [slot for slot in all_slots if slot not in booked_slots]
-    
-    @staticmethod
-    def get_by_id(appointment_id):
-        """Get appointment by ID."""
-        if isinstance(appointment_id, str):
-            appointment_id = ObjectId(appointment_id)
-            
-        # Join with doctor information
+        # Everything the message needs, in one round trip
         pipeline = [
-            {'$match': {'_id': appointment_id}},
+            {'$match': {'_id': {'$in': candidate_ids}, 'reminder_claim': run_id}},
             {'$lookup': {
                 'from': 'users',
-                'localField': 'doctor_id',
+                'localField': 'patient_id',
                 'foreignField': '_id',
-                'as': 'doctor'
+                'as': 'patient'
             }},
-            {'$unwind': '$doctor'},
+            # Keep appointments whose user is gone so the caller can mark them skipped
+            {'$unwind': {'path': '$patient', 'preserveNullAndEmptyArrays': True}},
             {'$lookup': {
                 'from': 'users',
-                'localField': 'patient_id',
+                'localField': 'doctor_id',
                 'foreignField': '_id',
-                'as': 'patient'
+                'as': 'doctor'
             }},
-            {'$unwind': '$patient'},
+            {'$unwind': {'path': '$doctor', 'preserveNullAndEmptyArrays': True}},
             {'$project': {
-                'doctor_password': 0,
-                'patient_password': 0
-            }}
+                '_id': 1,
+                'date': 1,
+                'time_slot': 1,
+                'patient_name': '$patient.name',
+                'patient_email': '$patient.email',
+                'doctor_name': '$doctor.name'
+            }},
+            {'$sort': {'_id': 1}}
         ]
+        return list(appointments.aggregate(pipeline))
+    
+    @staticmethod
+    def record_reminders(sent_ids, failed_ids=(), skipped_ids=()):
+        """Record the outcome of a reminder batch with a single bulk write.
+        
+        Sent and skipped appointments are never claimed again; failed ones
+        are released so a later run retries them.
+        """
+        now = datetime.utcnow()
+        release = {'reminder_claim': '', 'reminder_claimed_at': ''}
+        operations = [UpdateOne(
+            {'_id': appointment_id},
+            {'$set': {'reminder_sent': True, 'reminder_sent_at': now}, '$unset': release}
+        ) for appointment_id in sent_ids]
+        operations += [UpdateOne(
+            {'_id': appointment_id},
+            {'$set': {'reminder_skipped': True}, '$unset': release}
+        ) for appointment_id in skipped_ids]
+        operations += [UpdateOne(
+            {'_id': appointment_id},
+            {'$unset': release}
+        ) for appointment_id in failed_ids]
+        
+        if operations:
+            appointments.bulk_write(operations, ordered=False)
+    
+    @staticmethod
+    def get_by_id(appointment_id):
+        """Get appointment by ID."""
+        if isinstance(appointment_id, str):
+            appointment_id = ObjectId(appointment_id)
+            
+        appointment = appointments.find_one({'_id': appointment_id})
+        if not appointment:
+            return None
         
-        result = list(appointments.aggregate(pipeline))
-        return result[0] if result else None
+        # Templates read appointment.doctor.name; build it from the snapshot
+        for role in ('doctor', 'patient'):
+            appointment[role] = {'_id': appointment.get(f'{role}_id')}
+            for field in SNAPSHOT_FIELDS:
+                appointment[role][field] = appointment.get(f'{role}_{field}')
+        return appointment
     
     @staticmethod
     def update_appointment(appointment_id, update_data):
@@ -364,21 +633,34 @@ class Appointment:
             if 'priority' in update_data:
                 update_data['priority'] = int(update_data['priority'])
             
-            # Verify the appointment exists before updating
-            existing = appointments.find_one({'_id': appointment_id})
-            if not existing:
-                raise ValueError('Appointment not found')
+            update = {'$set': update_data}
+            if 'status' in update_data:
+                Appointment._with_slot_hold(update, update_data['status'])
             
-            # Perform the update
-            result = appointments.update_one(
-                {'_id': appointment_id},
-                {'$set': update_data}
-            )
+            # Perform the update, keeping the previous state for queue accounting
+            try:
+                existing = appointments.find_one_and_update(
+                    {'_id': appointment_id},
+                    update,
+                    return_document=ReturnDocument.BEFORE
+                )
+            except DuplicateKeyError as e:
+                # Rescheduled onto a slot someone else holds
+                raise Appointment._slot_conflict(e)
             
-            if result.matched_count == 0:
+            if not existing:
                 raise ValueError('Appointment not found')
+            
+            status = update_data.get('status', existing.get('status'))
+            if status != existing.get('status'):
+                # Also bumps the change versions
+                QueueManager.record_transition(existing, status)
+            else:
+                # Reschedules and other edits that leave the status alone
+                ChangeVersions.bump(ChangeVersions.keys_for(existing))
+                Appointment._publish_change({**existing, **update_data}, existing.get('status'))
                 
-            return result.modified_count > 0
+            return any(existing.get(key) != value for key, value in update_data.items())
             
         except Exception as e:
             raise ValueError(f"Error updating appointment: {str(e)}")
@@ -406,7 +688,8 @@ class Appointment:
                 'doctor_id': doctor_id,
                 'date': date,
                 'time_slot': time_slot,
-                'status': {'$nin': ['cancelled', 'completed']}
+                # Same rule as slot_held: only a cancellation frees the slot
+                'status': {'$ne': 'cancelled'}
             }
             
             # Exclude the current appointment if provided
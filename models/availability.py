@@ -0,0 +1,96 @@
+from . import appointments
+from datetime import datetime, timedelta
+from bson import ObjectId
+
+# Bookable consultation slots, in display order (HH:MM-HH:MM format)
+TIME_SLOTS = [
+    "09:00-09:30", "09:30-10:00", "10:00-10:30", "10:30-11:00",
+    "11:00-11:30", "11:30-12:00", "14:00-14:30", "14:30-15:00",
+    "15:00-15:30", "15:30-16:00", "16:00-16:30", "16:30-17:00"
+]
+SLOT_INDEX = {slot: i for i, slot in enumerate(TIME_SLOTS)}
+FULL_DAY = (1 << len(TIME_SLOTS)) - 1
+
+# Longest date range answered by a single availability lookup
+MAX_RANGE_DAYS = 31
+
+class AvailabilityEngine:
+    """Answer free-slot questions from one indexed query per doctor.
+
+    Each day is reduced to an integer bitmap where bit ``i`` is set when
+    ``TIME_SLOTS[i]`` is taken, so membership tests and range answers never
+    go back to the database.
+    """
+
+    @staticmethod
+    def booked_bitmaps(doctor_id, start_date, end_date=None, exclude_appointment_id=None):
+        """Get booked-slot bitmaps for a doctor.
+
+        Args:
+            doctor_id: The ID of the doctor
+            start_date: First date to include (YYYY-MM-DD format)
+            end_date: Optional last date to include, defaults to start_date
+            exclude_appointment_id: Optional appointment ID to ignore (rescheduling)
+
+        Returns:
+            dict: Mapping of date -> bitmap, only for dates with bookings
+        """
+        if isinstance(doctor_id, str):
+            doctor_id = ObjectId(doctor_id)
+
+        query = {
+            'doctor_id': doctor_id,
+            'date': start_date if not end_date or end_date == start_date
+                    else {'$gte': start_date, '$lte': end_date},
+            'status': {'$ne': 'cancelled'}
+        }
+        if exclude_appointment_id:
+            if isinstance(exclude_appointment_id, str):
+                exclude_appointment_id = ObjectId(exclude_appointment_id)
+            query['_id'] = {'$ne': exclude_appointment_id}
+
+        bitmaps = {}
+        for appt in appointments.find(query, {'_id': 0, 'date': 1, 'time_slot': 1}):
+            index = SLOT_INDEX.get(appt.get('time_slot'))
+            if index is None:
+                continue
+            bitmaps[appt['date']] = bitmaps.get(appt['date'], 0) | (1 << index)
+        return bitmaps
+
+    @staticmethod
+    def slots_from_bitmap(booked):
+        """Expand a booked bitmap into the list of free slots."""
+        free = FULL_DAY & ~booked
+        return [slot for i, slot in enumerate(TIME_SLOTS) if free >> i & 1]
+
+    @staticmethod
+    def free_slots(doctor_id, date, exclude_appointment_id=None):
+        """Get free time slots for a doctor on a specific date."""
+        bitmaps = AvailabilityEngine.booked_bitmaps(
+            doctor_id, date, exclude_appointment_id=exclude_appointment_id
+        )
+        return AvailabilityEngine.slots_from_bitmap(bitmaps.get(date, 0))
+
+    @staticmethod
+    def free_slots_range(doctor_id, start_date, end_date, exclude_appointment_id=None):
+        """Get free time slots for every date in an inclusive range.
+
+        Raises:
+            ValueError: If the dates are malformed or the range is too long
+        """
+        start = datetime.strptime(start_date, '%Y-%m-%d')
+        end = datetime.strptime(end_date, '%Y-%m-%d')
+        days = (end - start).days + 1
+        if days < 1:
+            raise ValueError('end_date must not be before start_date')
+        if days > MAX_RANGE_DAYS:
+            raise ValueError(f'Date range cannot exceed {MAX_RANGE_DAYS} days')
+
+        bitmaps = AvailabilityEngine.booked_bitmaps(
+            doctor_id, start_date, end_date, exclude_appointment_id
+        )
+        result = {}
+        for offset in range(days):
+            day = (start + timedelta(days=offset)).strftime('%Y-%m-%d')
+            result[day] = AvailabilityEngine.slots_from_bitmap(bitmaps.get(day, 0))
+        return result
@@ -0,0 +1,86 @@
+"""Resumable data backfills for the healthcare collections.
+
+    python -m models.backfill snapshots             # copy names/phones onto appointments
+    python -m models.backfill snapshots --restart   # start again from the first appointment
+
+Progress is checkpointed in schema_meta after every batch, so an
+interrupted run picks up where it stopped.
+"""
+from . import db, appointments, users
+from .appointment import Appointment, SNAPSHOT_FIELDS
+from datetime import datetime
+from pymongo import UpdateOne
+import argparse
+import sys
+
+# Appointments rewritten per bulk write
+BACKFILL_BATCH_SIZE = 500
+
+SNAPSHOT_CHECKPOINT = 'backfill_snapshots'
+
+def backfill_snapshots(batch_size=BACKFILL_BATCH_SIZE, restart=False, progress=None):
+    """Copy doctor and patient display fields onto every appointment.
+
+    Walks appointments in _id order, reading the users of each batch with
+    one query and writing the batch with one bulk write.
+
+    Args:
+        batch_size: Appointments per batch
+        restart: Ignore the saved checkpoint
+        progress: Optional callable receiving the running total after each batch
+
+    Returns:
+        int: Number of appointments updated by this run
+    """
+    checkpoint = None if restart else db.schema_meta.find_one({'_id': SNAPSHOT_CHECKPOINT})
+    last_id = checkpoint.get('last_id') if checkpoint else None
+    updated = 0
+
+    while True:
+        query = {'_id': {'$gt': last_id}} if last_id else {}
+        batch = list(appointments.find(query, {'doctor_id': 1, 'patient_id': 1})
+                     .sort('_id', 1).limit(batch_size))
+        if not batch:
+            break
+
+        user_ids = {appt.get('doctor_id') for appt in batch} | {appt.get('patient_id') for appt in batch}
+        people = {user['_id']: user for user in users.find(
+            {'_id': {'$in': [user_id for user_id in user_ids if user_id]}},
+            {field: 1 for field in SNAPSHOT_FIELDS}
+        )}
+        operations = []
+        for appt in batch:
+            snapshot = Appointment.snapshot('doctor', people.get(appt.get('doctor_id')))
+            snapshot.update(Appointment.snapshot('patient', people.get(appt.get('patient_id'))))
+            operations.append(UpdateOne({'_id': appt['_id']}, {'$set': snapshot}))
+        appointments.bulk_write(operations, ordered=False)
+
+        last_id = batch[-1]['_id']
+        updated += len(batch)
+        db.schema_meta.update_one(
+            {'_id': SNAPSHOT_CHECKPOINT},
+            {'$set': {'last_id': last_id, 'updated_at': datetime.utcnow()}},
+            upsert=True
+        )
+        if progress:
+            progress(updated)
+
+    return updated
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Backfill denormalized appointment fields')
+    parser.add_argument('action', choices=['snapshots'])
+    parser.add_argument('--batch-size', type=int, default=BACKFILL_BATCH_SIZE)
+    parser.add_argument('--restart', action='store_true', help='ignore the saved checkpoint')
+    args = parser.parse_args(argv)
+
+    updated = backfill_snapshots(
+        batch_size=args.batch_size,
+        restart=args.restart,
+        progress=lambda total: print(f"{total} appointments updated")
+    )
+    print(f"Done, {updated} appointments updated")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
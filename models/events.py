@@ -0,0 +1,153 @@
+from . import db
+from datetime import datetime
+from pymongo import CursorType
+from pymongo.errors import CollectionInvalid, PyMongoError
+import os
+import queue
+import threading
+import time
+
+# Capped collection every web worker tails for dashboard events
+EVENTS_COLLECTION = 'events'
+EVENTS_CAPPED_BYTES = 4 * 1024 * 1024
+
+# Events buffered per open stream before the oldest are dropped
+SUBSCRIBER_BUFFER = 100
+
+class Subscription:
+    """One open event stream, listening on a set of topics."""
+
+    def __init__(self, topics):
+        self.topics = set(topics)
+        self._queue = queue.Queue(maxsize=SUBSCRIBER_BUFFER)
+
+    def push(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            # A stalled client only needs to know something changed
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                pass
+            self._queue.put_nowait(event)
+
+    def get(self, timeout=None):
+        """Wait for the next event, returning None on timeout."""
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+class EventBus:
+    """Publish appointment and queue changes, fan them out to open streams.
+
+    Events are written once to a capped collection. Each worker process
+    tails it with a single cursor and dispatches in memory, so database
+    load follows the event rate, not the number of connected dashboards.
+    """
+
+    _lock = threading.Lock()
+    _subscribers = set()
+    _listener = None
+    _listener_pid = None
+    _collection_ready = False
+
+    @staticmethod
+    def topics_for(appointment):
+        """Topics interested in a change to this appointment."""
+        topics = []
+        if appointment.get('patient_id'):
+            topics.append(f"patient:{appointment['patient_id']}")
+        if appointment.get('doctor_id'):
+            topics.append(f"doctor:{appointment['doctor_id']}")
+        if appointment.get('department'):
+            topics.append(f"department:{appointment['department']}")
+        return topics
+
+    @staticmethod
+    def _ensure_collection():
+        if EventBus._collection_ready:
+            return
+        try:
+            db.create_collection(EVENTS_COLLECTION, capped=True, size=EVENTS_CAPPED_BYTES)
+        except CollectionInvalid:
+            pass
+        EventBus._collection_ready = True
+
+    @staticmethod
+    def publish(kind, topics, data):
+        """Record an event for every stream subscribed to one of the topics."""
+        if not topics:
+            return
+        try:
+            EventBus._ensure_collection()
+            db[EVENTS_COLLECTION].insert_one({
+                'kind': kind,
+                'topics': list(topics),
+                'data': data,
+                'created_at': datetime.utcnow()
+            })
+        except PyMongoError as e:
+            # Dashboards fall back to polling; never fail the state change itself
+            print(f"Error publishing {kind} event: {str(e)}")
+
+    @staticmethod
+    def subscribe(topics):
+        subscription = Subscription(topics)
+        with EventBus._lock:
+            EventBus._subscribers.add(subscription)
+            EventBus._start_listener()
+        return subscription
+
+    @staticmethod
+    def unsubscribe(subscription):
+        with EventBus._lock:
+            EventBus._subscribers.discard(subscription)
+
+    @staticmethod
+    def _start_listener():
+        # Called with the lock held; a forked child must start its own thread
+        if EventBus._listener is not None and EventBus._listener_pid == os.getpid():
+            return
+        EventBus._listener = threading.Thread(target=EventBus._listen, name='event-bus', daemon=True)
+        EventBus._listener_pid = os.getpid()
+        EventBus._listener.start()
+
+    @staticmethod
+    def _dispatch(event):
+        topics = set(event.get('topics', []))
+        payload = {'kind': event['kind'], 'data': event.get('data', {})}
+        with EventBus._lock:
+            subscribers = [s for s in EventBus._subscribers if s.topics & topics]
+        for subscription in subscribers:
+            subscription.push(payload)
+
+    @staticmethod
+    def _listen():
+        collection = db[EVENTS_COLLECTION]
+        last_id = None
+        while True:
+            try:
+                EventBus._ensure_collection()
+                if last_id is None:
+                    newest = list(collection.find({}, {'_id': 1}).sort('$natural', -1).limit(1))
+                    last_id = newest[0]['_id'] if newest else None
+                query = {'_id': {'$gt': last_id}} if last_id else {}
+                cursor = collection.find(query, cursor_type=CursorType.TAILABLE_AWAIT, max_await_time_ms=1000)
+                while cursor.alive:
+                    for event in cursor:
+                        last_id = event['_id']
+                        EventBus._dispatch(event)
+                    with EventBus._lock:
+                        if not EventBus._subscribers:
+                            break
+                cursor.close()
+            except PyMongoError as e:
+                print(f"Event listener error: {str(e)}")
+            with EventBus._lock:
+                if not EventBus._subscribers:
+                    EventBus._listener = None
+                    return
+            # Tailable cursors die on an empty collection; retry shortly
+            time.sleep(1)
@@ -0,0 +1,203 @@
+"""Index manifest for the healthcare collections.
+
+Applied at deploy time rather than on import:
+
+    python -m models.indexes apply      # create missing indexes, record the version
+    python -m models.indexes check      # list hot queries that would scan a collection
+"""
+from . import db
+from datetime import datetime
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+import argparse
+import sys
+
+# Bump whenever INDEXES changes so deploys know to re-apply
+INDEX_MANIFEST_VERSION = 4
+
+# (collection, keys, options)
+INDEXES = [
+    ('appointments', [('doctor_id', ASCENDING), ('date', ASCENDING), ('time_slot', ASCENDING), ('status', ASCENDING)],
+     {'name': 'doctor_date_slot_status'}),
+    # History pages sort on (date, time_slot, _id) straight from these
+    ('appointments', [('patient_id', ASCENDING), ('status', ASCENDING), ('date', ASCENDING),
+                      ('time_slot', ASCENDING), ('_id', ASCENDING)],
+     {'name': 'patient_status_date_slot'}),
+    ('appointments', [('doctor_id', ASCENDING), ('status', ASCENDING), ('date', ASCENDING),
+                      ('time_slot', ASCENDING), ('_id', ASCENDING)],
+     {'name': 'doctor_status_date_slot'}),
+    ('appointments', [('department', ASCENDING), ('date', ASCENDING), ('status', ASCENDING)],
+     {'name': 'department_date_status'}),
+    # Double-booking guards. Partial filters cannot express status != cancelled,
+    # so live appointments carry slot_held and cancelling removes it.
+    ('appointments', [('doctor_id', ASCENDING), ('date', ASCENDING), ('time_slot', ASCENDING)],
+     {'name': 'doctor_slot_unique', 'unique': True, 'partialFilterExpression': {'slot_held': True}}),
+    ('appointments', [('patient_id', ASCENDING), ('date', ASCENDING), ('time_slot', ASCENDING)],
+     {'name': 'patient_slot_unique', 'unique': True, 'partialFilterExpression': {'slot_held': True}}),
+    # Day-wide scans: queue reconciliation and the reminder job
+    ('appointments', [('date', ASCENDING), ('status', ASCENDING), ('department', ASCENDING)],
+     {'name': 'date_status_department'}),
+    ('users', [('email', ASCENDING)],
+     {'name': 'email_unique', 'unique': True}),
+    ('users', [('role', ASCENDING), ('active', ASCENDING)],
+     {'name': 'role_active'}),
+    ('queue_status', [('department', ASCENDING), ('date', ASCENDING)],
+     {'name': 'department_date_unique', 'unique': True}),
+    ('queue_status', [('date', ASCENDING)],
+     {'name': 'date'}),
+    ('doctor_stats', [('doctor_id', ASCENDING)],
+     {'name': 'doctor_unique', 'unique': True}),
+    ('outbox', [('status', ASCENDING), ('next_attempt_at', ASCENDING)],
+     {'name': 'status_next_attempt'}),
+    ('outbox', [('dedupe_key', ASCENDING)],
+     {'name': 'dedupe_key_unique', 'unique': True, 'sparse': True}),
+    # Clears out snapshots a day after their worker stopped; /metrics retired their
+    # counts long before, and the retired totals document has no updated_at
+    ('request_metrics', [('updated_at', ASCENDING)],
+     {'name': 'updated_at_ttl', 'expireAfterSeconds': 24 * 60 * 60}),
+]
+
+# (collection, name) of indexes superseded by an entry above; dropped on apply
+RETIRED_INDEXES = [
+    ('appointments', 'patient_status_date'),
+]
+
+# (name, collection, filter, sort) for the queries on the request path
+_ID = ObjectId()
+_DAY = '2000-01-01'
+HOT_QUERIES = [
+    ('Appointment.get_by_patient', 'appointments',
+     {'patient_id': _ID, 'status': {'$in': ['scheduled', 'checked-in']}},
+     [('date', ASCENDING), ('time_slot', ASCENDING), ('_id', ASCENDING)]),
+    ('Appointment.get_by_patient history page', 'appointments',
+     {'patient_id': _ID, 'status': 'completed', 'date': {'$lte': _DAY}},
+     [('date', DESCENDING), ('time_slot', DESCENDING), ('_id', DESCENDING)]),
+    ('Appointment.get_by_doctor history page', 'appointments',
+     {'doctor_id': _ID, 'status': 'completed', 'date': {'$lte': _DAY}},
+     [('date', DESCENDING), ('time_slot', DESCENDING), ('_id', DESCENDING)]),
+    ('Appointment.get_by_doctor', 'appointments',
+     {'doctor_id': _ID, 'date': _DAY, 'status': {'$in': ['scheduled', 'checked-in']}}, [('date', ASCENDING), ('time_slot', ASCENDING)]),
+    ('Appointment.is_time_slot_available', 'appointments',
+     {'doctor_id': _ID, 'date': _DAY, 'time_slot': '09:00-09:30', 'status': {'$ne': 'cancelled'}}, None),
+    ('AvailabilityEngine.booked_bitmaps', 'appointments',
+     {'doctor_id': _ID, 'date': {'$gte': _DAY, '$lte': _DAY}, 'status': {'$ne': 'cancelled'}}, None),
+    ('QueueManager.get_queue', 'appointments',
+     {'department': 'General', 'date': _DAY, 'status': 'checked-in'}, None),
+    ('QueueManager.reconcile', 'appointments',
+     {'date': _DAY, 'status': {'$in': ['checked-in', 'in-progress', 'completed']}}, None),
+    ('Appointment.claim_reminder_batch', 'appointments',
+     {'date': _DAY, 'status': 'scheduled', 'reminder_sent': {'$ne': True}}, [('_id', ASCENDING)]),
+    ('QueueManager.get_department_status', 'queue_status',
+     {'department': 'General', 'date': _DAY}, None),
+    ('User.get_by_email', 'users', {'email': 'someone@example.com'}, None),
+    ('User.get_doctors', 'users', {'role': 'doctor', 'active': True}, None),
+    ('WaitTimePredictor.get_stats', 'doctor_stats', {'doctor_id': _ID}, None),
+    ('Outbox.claim_batch', 'outbox',
+     {'status': 'pending', 'next_attempt_at': {'$lte': datetime(2000, 1, 1)}}, [('next_attempt_at', ASCENDING)]),
+]
+
+def _backfill_slot_held():
+    """Mark appointments booked before slot_held existed (manifest v2)."""
+    db.appointments.update_many(
+        {'status': {'$ne': 'cancelled'}, 'slot_held': {'$exists': False}},
+        {'$set': {'slot_held': True}}
+    )
+
+# Data fixes that must run before the indexes that depend on them are built
+BACKFILLS = [_backfill_slot_held]
+
+def applied_version():
+    """The manifest version last applied to this database, or None."""
+    meta = db.schema_meta.find_one({'_id': 'indexes'})
+    return meta['version'] if meta else None
+
+def apply_indexes(force=False):
+    """Create every index in the manifest.
+
+    Skipped when this manifest version was already applied, unless forced.
+
+    Returns:
+        list: (collection, index name, error or None) for each index attempted
+    """
+    if not force and applied_version() == INDEX_MANIFEST_VERSION:
+        return []
+
+    for backfill in BACKFILLS:
+        backfill()
+
+    results = []
+    for collection, keys, options in INDEXES:
+        try:
+            db[collection].create_index(keys, **options)
+            results.append((collection, options['name'], None))
+        except OperationFailure as e:
+            # e.g. duplicate emails or existing double bookings blocking a
+            # unique index; report and carry on
+            results.append((collection, options['name'], str(e)))
+
+    existing = {}
+    for collection, name in RETIRED_INDEXES:
+        if collection not in existing:
+            existing[collection] = set(db[collection].index_information())
+        if name in existing[collection]:
+            db[collection].drop_index(name)
+            results.append((collection, f"{name} (dropped)", None))
+
+    if all(error is None for _, _, error in results):
+        db.schema_meta.update_one(
+            {'_id': 'indexes'},
+            {'$set': {'version': INDEX_MANIFEST_VERSION, 'applied_at': datetime.utcnow()}},
+            upsert=True
+        )
+    return results
+
+def _plan_stages(plan):
+    stages = [plan.get('stage')]
+    for child in [plan.get('inputStage')] + plan.get('inputStages', []):
+        if child:
+            stages += _plan_stages(child)
+    return stages
+
+def unindexed_queries():
+    """Explain each hot query and return those the planner would answer with a COLLSCAN.
+
+    Returns:
+        list: (query name, collection, winning plan stages)
+    """
+    missing = []
+    for name, collection, query, sort in HOT_QUERIES:
+        command = {'find': collection, 'filter': query}
+        if sort:
+            command['sort'] = dict(sort)
+        explain = db.command('explain', command, verbosity='queryPlanner')
+        winning = explain['queryPlanner']['winningPlan']
+        # Plans from the slot-based engine nest the classic plan under queryPlan
+        stages = _plan_stages(winning.get('queryPlan', winning))
+        if 'COLLSCAN' in stages:
+            missing.append((name, collection, stages))
+    return missing
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Manage healthcare collection indexes')
+    parser.add_argument('action', choices=['apply', 'check'])
+    parser.add_argument('--force', action='store_true', help='re-apply even if this version was applied')
+    args = parser.parse_args(argv)
+
+    if args.action == 'apply':
+        results = apply_indexes(force=args.force)
+        if not results:
+            print(f"Index manifest v{INDEX_MANIFEST_VERSION} already applied")
+        for collection, name, error in results:
+            print(f"{collection}.{name}: {'FAILED - ' + error if error else 'ok'}")
+        return 1 if any(error for _, _, error in results) else 0
+
+    missing = unindexed_queries()
+    for name, collection, stages in missing:
+        print(f"{name} ({collection}) scans the collection: {' <- '.join(stages)}")
+    if not missing:
+        print('All hot queries are index-backed')
+    return 1 if missing else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,164 @@
+from . import outbox
+from datetime import datetime, timedelta
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+# Outbox message states
+PENDING = 'pending'
+SENDING = 'sending'
+SENT = 'sent'
+DEAD = 'dead'
+
+class Outbox:
+    """Persistent queue of outbound e-mail.
+
+    Requests and jobs only insert documents here; MailWorkerPool (in
+    mail_worker.py) delivers them in batches off the request path. The
+    claim and de-duplication indexes live in models/indexes.py.
+    """
+
+    @staticmethod
+    def _message(recipients, subject, body, kind=None, dedupe_key=None):
+        now = datetime.utcnow()
+        message = {
+            'recipients': list(recipients),
+            'subject': subject,
+            'body': body,
+            'kind': kind,
+            'status': PENDING,
+            'attempts': 0,
+            'created_at': now,
+            'next_attempt_at': now,
+            'last_error': None
+        }
+        if dedupe_key:
+            message['dedupe_key'] = dedupe_key
+        return message
+
+    @staticmethod
+    def enqueue(recipients, subject, body, kind=None, dedupe_key=None):
+        """Queue a single message.
+
+        Returns:
+            bool: False if a message with the same dedupe_key was already queued
+        """
+        return Outbox.enqueue_many([{
+            'recipients': recipients,
+            'subject': subject,
+            'body': body,
+            'kind': kind,
+            'dedupe_key': dedupe_key
+        }]) == 1
+
+    @staticmethod
+    def enqueue_many(messages):
+        """Queue several messages with one insert.
+
+        Messages whose dedupe_key is already queued are skipped, which makes
+        re-running a job that enqueues mail safe.
+
+        Returns:
+            int: Number of messages newly queued
+        """
+        documents = [Outbox._message(**message) for message in messages]
+        if not documents:
+            return 0
+        try:
+            return len(outbox.insert_many(documents, ordered=False).inserted_ids)
+        except BulkWriteError as e:
+            duplicates = [err for err in e.details.get('writeErrors', []) if err.get('code') == 11000]
+            if len(duplicates) != len(e.details.get('writeErrors', [])):
+                raise
+            return e.details.get('nInserted', 0)
+
+    @staticmethod
+    def claim_batch(worker_id, limit=50, lease_seconds=300):
+        """Claim up to limit messages that are due for delivery.
+
+        A message claimed by a worker that died is reclaimed once its lease
+        expires.
+
+        Returns:
+            list: The claimed message documents
+        """
+        now = datetime.utcnow()
+        due = {'$or': [
+            {'status': PENDING, 'next_attempt_at': {'$lte': now}},
+            {'status': SENDING, 'claimed_at': {'$lt': now - timedelta(seconds=lease_seconds)}}
+        ]}
+        candidate_ids = [message['_id'] for message in
+                         outbox.find(due, {'_id': 1}).sort('next_attempt_at', 1).limit(limit)]
+        if not candidate_ids:
+            return []
+
+        outbox.update_many(
+            {'$and': [due, {'_id': {'$in': candidate_ids}}]},
+            {'$set': {'status': SENDING, 'claimed_by': worker_id, 'claimed_at': now}}
+        )
+        return list(outbox.find({'_id': {'$in': candidate_ids}, 'status': SENDING, 'claimed_by': worker_id}))
+
+    @staticmethod
+    def record_batch(sent, failed, max_attempts=5, retry_base_seconds=30, permanent=()):
+        """Record the outcome of a delivery batch with one bulk write.
+
+        Args:
+            sent: Messages that were delivered
+            failed: (message, error) pairs to retry with exponential backoff
+            max_attempts: Attempts after which a message is dead-lettered
+            retry_base_seconds: Delay before the first retry
+            permanent: (message, error) pairs to dead-letter immediately
+
+        Returns:
+            int: Number of messages dead-lettered by this call
+        """
+        now = datetime.utcnow()
+        release = {'claimed_by': '', 'claimed_at': ''}
+        operations = [UpdateOne(
+            {'_id': message['_id']},
+            {'$set': {'status': SENT, 'sent_at': now}, '$inc': {'attempts': 1}, '$unset': release}
+        ) for message in sent]
+
+        dead = 0
+        failures = [(m, e, False) for m, e in failed] + [(m, e, True) for m, e in permanent]
+        for message, error, is_permanent in failures:
+            attempts = message.get('attempts', 0) + 1
+            if is_permanent or attempts >= max_attempts:
+                update = {'status': DEAD, 'dead_at': now}
+                dead += 1
+            else:
+                # 30s, 60s, 120s, ... capped at one hour
+                delay = min(retry_base_seconds * 2 ** (attempts - 1), 3600)
+                update = {'status': PENDING, 'next_attempt_at': now + timedelta(seconds=delay)}
+            update['last_error'] = str(error)[:500]
+            operations.append(UpdateOne(
+                {'_id': message['_id']},
+                {'$set': update, '$inc': {'attempts': 1}, '$unset': release}
+            ))
+
+        if operations:
+            outbox.bulk_write(operations, ordered=False)
+        return dead
+
+    @staticmethod
+    def requeue_dead(limit=None):
+        """Give dead-lettered messages another full set of attempts."""
+        query = {'status': DEAD}
+        if limit:
+            ids = [m['_id'] for m in outbox.find(query, {'_id': 1}).limit(limit)]
+            query = {'_id': {'$in': ids}}
+        result = outbox.update_many(query, {
+            '$set': {'status': PENDING, 'attempts': 0, 'next_attempt_at': datetime.utcnow()}
+        })
+        return result.modified_count
+
+    @staticmethod
+    def stats():
+        """Message counts by status plus the age of the oldest pending message."""
+        counts = {PENDING: 0, SENDING: 0, SENT: 0, DEAD: 0}
+        for row in outbox.aggregate([{'$group': {'_id': '$status', 'count': {'$sum': 1}}}]):
+            counts[row['_id']] = row['count']
+        oldest = outbox.find_one({'status': PENDING}, {'created_at': 1}, sort=[('created_at', 1)])
+        counts['oldest_pending_seconds'] = (
+            (datetime.utcnow() - oldest['created_at']).total_seconds() if oldest else 0
+        )
+        return counts
@@ -0,0 +1,161 @@
+"""bcrypt hashing on a dedicated, bounded pool of threads.
+
+bcrypt releases the GIL, so a few hashing threads use a few cores while
+request threads wait on them. Capping both the threads and the number of
+waiting jobs means a burst of logins queues here (or is turned away with
+PasswordHasherBusy) instead of tying up every request thread and starving
+the queue endpoints.
+"""
+from config import Config
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from .stats import percentile, recent_samples
+import bcrypt
+import os
+import queue
+import threading
+import time
+
+class PasswordHasherBusy(Exception):
+    """Raised when the hashing queue is full or a job waited too long."""
+
+class PasswordHasher:
+    """A fixed set of threads running bcrypt jobs from a bounded queue."""
+
+    def __init__(self, rounds=12, workers=2, queue_size=64, timeout=5.0):
+        self.rounds = rounds
+        self.workers = workers
+        self.timeout = timeout
+        self.queue_size = queue_size
+        self._jobs = queue.Queue(maxsize=queue_size)
+        self._threads = []
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._counters = {'hashed': 0, 'verified': 0, 'rehashed': 0, 'rejected': 0}
+        # Recent samples for percentiles: time queued and time spent in bcrypt
+        self._queue_wait = recent_samples()
+        self._hash_time = recent_samples()
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            # Threads do not survive a fork; a forked worker starts its own
+            self._jobs = queue.Queue(maxsize=self.queue_size)
+            self._threads = []
+            for n in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f'password-hasher-{n}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            self._pid = os.getpid()
+
+    def _run(self):
+        jobs = self._jobs
+        while True:
+            future, queued_at, counter, fn, args = jobs.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            started = time.monotonic()
+            try:
+                result = fn(*args)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+            finished = time.monotonic()
+            with self._lock:
+                self._counters[counter] += 1
+                self._queue_wait.append(started - queued_at)
+                self._hash_time.append(finished - started)
+
+    def _submit(self, counter, fn, *args):
+        self._ensure_started()
+        future = Future()
+        try:
+            self._jobs.put_nowait((future, time.monotonic(), counter, fn, args))
+        except queue.Full:
+            with self._lock:
+                self._counters['rejected'] += 1
+            raise PasswordHasherBusy('Password hashing queue is full')
+        return future
+
+    def _wait(self, future):
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeout:
+            # Still queued: drop it so a worker does not spend a bcrypt on it
+            future.cancel()
+            with self._lock:
+                self._counters['rejected'] += 1
+            raise PasswordHasherBusy('Timed out waiting for password hashing')
+
+    @staticmethod
+    def _encode(value):
+        return value.encode('utf-8') if isinstance(value, str) else value
+
+    def _hashpw(self, password):
+        return bcrypt.hashpw(self._encode(password), bcrypt.gensalt(rounds=self.rounds))
+
+    def hash(self, password):
+        """bcrypt hash of password at the configured cost."""
+        return self._wait(self._submit('hashed', self._hashpw, password))
+
+    def verify(self, password, hashed):
+        """Whether password matches a stored bcrypt hash."""
+        return self._wait(self._submit(
+            'verified', bcrypt.checkpw, self._encode(password), self._encode(hashed)
+        ))
+
+    def needs_rehash(self, hashed):
+        """Whether a stored hash was made with a different cost than the configured one."""
+        try:
+            # $2b$12$<salt and hash>
+            return int(self._encode(hashed).split(b'$')[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+    def rehash_later(self, password, callback):
+        """Hash password at the configured cost in the background.
+
+        callback receives the new hash. Nothing waits on the job, and if
+        the queue is full it is skipped; the next login tries again.
+
+        Returns:
+            bool: Whether the job was queued
+        """
+        def rehash():
+            try:
+                callback(self._hashpw(password))
+            except Exception as e:
+                print(f"Error rehashing password: {str(e)}")
+        try:
+            self._submit('rehashed', rehash)
+        except PasswordHasherBusy:
+            return False
+        return True
+
+    def metrics(self):
+        """Job counts, queue depth and latency of this process's hashing threads."""
+        with self._lock:
+            counters = dict(self._counters)
+            queue_wait = list(self._queue_wait)
+            hash_time = list(self._hash_time)
+        counters.update({
+            'workers': len(self._threads),
+            'rounds': self.rounds,
+            'queue_depth': self._jobs.qsize(),
+            'queue_wait_p50': percentile(queue_wait, 0.5),
+            'queue_wait_p95': percentile(queue_wait, 0.95),
+            'hash_time_p50': percentile(hash_time, 0.5),
+            'hash_time_p95': percentile(hash_time, 0.95)
+        })
+        return counters
+
+password_hasher = PasswordHasher(
+    rounds=Config.BCRYPT_ROUNDS,
+    workers=Config.PASSWORD_HASH_WORKERS,
+    queue_size=Config.PASSWORD_HASH_QUEUE_SIZE,
+    timeout=Config.PASSWORD_HASH_TIMEOUT
+)
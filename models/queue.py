@@ -1,98 +1,438 @@
 from . import queue_status, appointments
 from datetime import datetime, timedelta
 from bson import ObjectId
+from pymongo import ReturnDocument
+from .events import EventBus
+from .versions import ChangeVersions
+from .wait_time import WaitTimePredictor
+import bisect
+import threading
+
+# Appointment status -> per-day counter kept on the queue_status document
+STATUS_COUNTERS = {
+    'checked-in': 'checked_in_count',
+    'in-progress': 'in_progress_count',
+    'completed': 'completed_count'
+}
+
+class WaitingQueue:
+    """Checked-in appointments for one doctor, ordered by priority then check-in time.
+
+    Entries live in a sorted list searched with bisect, so insert and remove
+    are O(log n) comparisons. Ranks are materialised lazily after a change,
+    which makes repeated position lookups O(1).
+
+    A queue cached in QueueManager._queues is shared between threads, so
+    it is only read or changed while holding QueueManager._queues_lock.
+    """
+
+    def __init__(self):
+        self._keys = []
+        self._entries = {}
+        self._ranks = None
+
+    @staticmethod
+    def _key(appointment):
+        # Higher priority first (2=emergency), then first come first served
+        return (
+            -int(appointment.get('priority') or 0),
+            appointment.get('check_in_time') or datetime.min,
+            str(appointment['_id'])
+        )
+
+    def add(self, appointment):
+        appointment_id = str(appointment['_id'])
+        self.remove(appointment_id)
+        key = WaitingQueue._key(appointment)
+        bisect.insort(self._keys, key)
+        self._entries[appointment_id] = key
+        self._ranks = None
+
+    def remove(self, appointment_id):
+        key = self._entries.pop(str(appointment_id), None)
+        if key is None:
+            return False
+        del self._keys[bisect.bisect_left(self._keys, key)]
+        self._ranks = None
+        return True
+
+    def position(self, appointment_id):
+        """1-based place in line, or None if not waiting."""
+        ranks = self._ranks
+        if ranks is None:
+            ranks = self._ranks = {key[2]: rank for rank, key in enumerate(self._keys, 1)}
+        return ranks.get(str(appointment_id))
+
+    def __contains__(self, appointment_id):
+        return str(appointment_id) in self._entries
+
+    def __iter__(self):
+        """Appointment IDs in queue order."""
+        return (key[2] for key in self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+class DepartmentQueue:
+    """The per-doctor waiting queues of one department on one day.
+
+    ``version`` mirrors the queue_status document it was built from; a
+    mismatch means another worker changed the queue and it must be rebuilt.
+    """
+
+    def __init__(self, version):
+        self.version = version
+        self._doctors = {}
+        self._doctor_of = {}
+
+    def add(self, appointment):
+        appointment_id = str(appointment['_id'])
+        doctor_id = str(appointment.get('doctor_id'))
+        self.remove(appointment_id)
+        self._doctors.setdefault(doctor_id, WaitingQueue()).add(appointment)
+        self._doctor_of[appointment_id] = doctor_id
+
+    def remove(self, appointment_id):
+        doctor_id = self._doctor_of.pop(str(appointment_id), None)
+        if doctor_id is not None:
+            self._doctors[doctor_id].remove(appointment_id)
+
+    def position(self, appointment_id):
+        doctor_id = self._doctor_of.get(str(appointment_id))
+        if doctor_id is None:
+            return None
+        return self._doctors[doctor_id].position(appointment_id)
+
+    def waiting(self, doctor_id):
+        """Number of patients waiting for a doctor."""
+        queue = self._doctors.get(str(doctor_id))
+        return len(queue) if queue else 0
+
+    def waiting_ids(self, doctor_id):
+        """Appointment IDs waiting for a doctor, next patient first."""
+        return list(self._doctors.get(str(doctor_id), ()))
 
 class QueueManager:
+    # (department, date) -> DepartmentQueue, shared by the threads of this worker
+    _queues = {}
+    _queues_lock = threading.Lock()
+
     @staticmethod
-    def update_department_status(department):
-        """Update the queue status for a department."""
-        # Get today's appointments for this department
-        today = datetime.utcnow().strftime('%Y-%m-%d')
-        
-        # Find all checked-in appointments
-        checked_in = appointments.find({
-            'department': department,
-            'date': today,
-            'status': 'checked-in'
-        }).count()
-        
-        # Find all in-progress appointments
-        in_progress = appointments.find({
-            'department': department,
-            'date': today,
-            'status': 'in-progress'
-        }).count()
-        
-        # Calculate average wait time based on completed appointments today
-        completed = list(appointments.find({
-            'department': department,
-            'date': today,
-            'status': 'completed',
-            'check_in_time': {'$exists': True},
-            'actual_start_time': {'$exists': True}
-        }))
-        
-        avg_wait_time = 0
-        if completed:
-            wait_times = [(app['actual_start_time'] - app['check_in_time']).total_seconds() / 60 for app in completed]
-            avg_wait_time = sum(wait_times) / len(wait_times)
-        
-        # Calculate estimated wait time (simple approximation)
-        estimated_wait = avg_wait_time * checked_in
-        
-        # Update queue status
-        queue_status.update_one(
-            {'department': department},
-            {
-                '$set': {
-                    'checked_in_count': checked_in,
-                    'in_progress_count': in_progress,
-                    'avg_wait_time': avg_wait_time,
-                    'estimated_wait': estimated_wait,
-                    'last_updated': datetime.utcnow()
-                }
-            },
-            upsert=True
+    def _today():
+        return datetime.now().strftime('%Y-%m-%d')
+
+    @staticmethod
+    def _with_derived(status):
+        """Fill in the averages computed from the running counters."""
+        if not status:
+            return status
+        wait_count = status.get('wait_time_count', 0)
+        avg_wait_time = status.get('wait_time_sum', 0) / wait_count if wait_count else 0
+        status['avg_wait_time'] = avg_wait_time
+        # Simple approximation: everyone waiting takes the average wait
+        status['estimated_wait'] = avg_wait_time * max(status.get('checked_in_count', 0), 0)
+        return status
+
+    @staticmethod
+    def record_transition(appointment, new_status, timestamp=None):
+        """Apply one appointment state change to its department counters.
+
+        Args:
+            appointment: The appointment document as it was before the change
+            new_status: The status the appointment moved to
+            timestamp: When the change happened, defaults to now (UTC)
+
+        Returns:
+            dict: Fresh wait estimates (appointment ID -> minutes) for the
+            doctor's waiting patients, or None if the queue did not change
+        """
+        if not appointment:
+            return None
+        old_status = appointment.get('status')
+        if old_status == new_status:
+            return None
+
+        inc = {}
+        if old_status in STATUS_COUNTERS:
+            inc[STATUS_COUNTERS[old_status]] = -1
+        if new_status in STATUS_COUNTERS:
+            inc[STATUS_COUNTERS[new_status]] = 1
+        timestamp = timestamp or datetime.utcnow()
+        if new_status == 'in-progress' and appointment.get('check_in_time'):
+            inc['wait_time_sum'] = (timestamp - appointment['check_in_time']).total_seconds() / 60
+            inc['wait_time_count'] = 1
+
+        etas = None
+        if inc:
+            inc['version'] = 1
+            status = queue_status.find_one_and_update(
+                {'department': appointment['department'], 'date': appointment['date']},
+                {
+                    '$inc': inc,
+                    '$set': {'last_updated': datetime.utcnow()}
+                },
+                projection={'version': 1},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+            QueueManager._apply_to_queue(appointment, new_status, timestamp, status['version'])
+            queue = QueueManager.get_queue(appointment['department'], appointment['date'], status['version'])
+            etas = QueueManager._refresh_wait_estimates(appointment, new_status, timestamp, queue)
+
+        # Push the change to open dashboards of the patient, doctor and department
+        EventBus.publish('appointment', EventBus.topics_for(appointment), {
+            'appointment_id': str(appointment['_id']),
+            'patient_id': str(appointment.get('patient_id')),
+            'doctor_id': str(appointment.get('doctor_id')),
+            'department': appointment.get('department'),
+            'date': appointment.get('date'),
+            'previous_status': old_status,
+            'status': new_status
+        })
+        ChangeVersions.bump(ChangeVersions.keys_for(appointment))
+        return etas
+
+    @staticmethod
+    def _refresh_wait_estimates(appointment, new_status, timestamp, queue):
+        """Update the doctor's consultation statistics and re-time their queue."""
+        doctor_id = appointment.get('doctor_id')
+        if not doctor_id:
+            return None
+        stats = None
+        if new_status == 'in-progress':
+            stats = WaitTimePredictor.set_current_consult(doctor_id, timestamp)
+        elif appointment.get('status') == 'in-progress':
+            if new_status == 'completed' and appointment.get('actual_start_time'):
+                minutes = (timestamp - appointment['actual_start_time']).total_seconds() / 60
+                stats = WaitTimePredictor.record_consultation(doctor_id, minutes)
+            else:
+                stats = WaitTimePredictor.set_current_consult(doctor_id, None)
+        with QueueManager._queues_lock:
+            waiting_ids = queue.waiting_ids(doctor_id)
+        return WaitTimePredictor.update_etas(doctor_id, waiting_ids, stats, timestamp)
+
+    @staticmethod
+    def _apply_to_queue(appointment, new_status, timestamp, version):
+        """Update this worker's cached queue in place when it is exactly one change behind."""
+        key = (appointment['department'], appointment['date'])
+        with QueueManager._queues_lock:
+            queue = QueueManager._queues.get(key)
+            if queue is None:
+                return
+            if queue.version != version - 1:
+                # Someone else changed it in between; rebuild on next read
+                del QueueManager._queues[key]
+                return
+            if appointment.get('status') == 'checked-in':
+                queue.remove(appointment['_id'])
+            if new_status == 'checked-in':
+                queue.add(dict(appointment, check_in_time=timestamp or datetime.utcnow()))
+            queue.version = version
+
+    @staticmethod
+    def get_queue(department, date=None, version=None):
+        """Get the waiting queue for a department, rebuilding it only when stale.
+
+        Args:
+            department: The department name
+            date: The day of the queue (YYYY-MM-DD), defaults to today
+            version: The queue_status version if the caller already has it
+
+        Returns:
+            DepartmentQueue: Positions for every checked-in appointment
+        """
+        date = date or QueueManager._today()
+        if version is None:
+            status = queue_status.find_one({'department': department, 'date': date}, {'version': 1})
+            version = (status or {}).get('version', 0)
+
+        key = (department, date)
+        with QueueManager._queues_lock:
+            queue = QueueManager._queues.get(key)
+            if queue is not None and queue.version == version:
+                return queue
+
+        queue = DepartmentQueue(version)
+        waiting = appointments.find(
+            {'department': department, 'date': date, 'status': 'checked-in'},
+            {'_id': 1, 'doctor_id': 1, 'priority': 1, 'check_in_time': 1}
         )
-        
+        for appointment in waiting:
+            queue.add(appointment)
+
+        with QueueManager._queues_lock:
+            QueueManager._queues[key] = queue
+            # Drop past days so the cache only holds live queues
+            today = QueueManager._today()
+            for stale in [k for k in QueueManager._queues if k[1] < today]:
+                del QueueManager._queues[stale]
+        return queue
+
+    @staticmethod
+    def get_queue_info(appointment, status=None):
+        """Queue position and expected wait for a checked-in appointment.
+
+        Args:
+            appointment: The appointment (needs _id, department and date)
+            status: The department status if the caller already loaded it
+
+        Returns:
+            dict: position and wait_time, or None if the department has no queue
+        """
+        status = status or QueueManager.get_department_status(appointment['department'])
+        if not status:
+            return None
+        queue = QueueManager.get_queue(appointment['department'], appointment['date'], status.get('version', 0))
+        with QueueManager._queues_lock:
+            position = queue.position(appointment['_id'])
+        # 0 is a real estimate: next in line
+        eta = appointment.get('estimated_wait_time')
         return {
-            'department': department,
-            'checked_in_count': checked_in,
-            'in_progress_count': in_progress,
-            'avg_wait_time': avg_wait_time,
-            'estimated_wait': estimated_wait
+            'position': position,
+            'wait_time': eta if eta is not None else status['estimated_wait']
         }
-    
+
+    @staticmethod
+    def attach_queue_info(appointment_list, statuses=None):
+        """Set queue_info on every checked-in appointment in the list.
+
+        The department statuses are read with one query for the whole list
+        rather than one per appointment, or taken from statuses when the
+        caller already joined them.
+        """
+        waiting = [appt for appt in appointment_list if appt.get('status') == 'checked-in']
+        if not waiting:
+            return appointment_list
+        if statuses is None:
+            departments = list({appt['department'] for appt in waiting})
+            statuses = queue_status.find({'date': QueueManager._today(), 'department': {'$in': departments}})
+        statuses = {status['department']: QueueManager._with_derived(status) for status in statuses}
+        for appt in waiting:
+            status = statuses.get(appt['department'])
+            if status:
+                appt['queue_info'] = QueueManager.get_queue_info(appt, status)
+        return appointment_list
+
+    @staticmethod
+    def reconcile(date=None, department=None):
+        """Recompute counters from the appointments collection to fix drift.
+
+        Runs one grouped aggregation for the day instead of per-department
+        scans, and is meant to be scheduled periodically rather than called
+        on every state change.
+
+        Returns:
+            list: The reconciled status documents
+        """
+        date = date or QueueManager._today()
+        match = {'date': date, 'status': {'$in': list(STATUS_COUNTERS)}}
+        if department:
+            match['department'] = department
+
+        has_wait = {'$and': [
+            {'$ne': [{'$ifNull': ['$check_in_time', None]}, None]},
+            {'$ne': [{'$ifNull': ['$actual_start_time', None]}, None]}
+        ]}
+        group = {'_id': '$department'}
+        for status, field in STATUS_COUNTERS.items():
+            group[field] = {'$sum': {'$cond': [{'$eq': ['$status', status]}, 1, 0]}}
+        group['wait_time_sum'] = {'$sum': {'$cond': [
+            has_wait,
+            {'$divide': [{'$subtract': ['$actual_start_time', '$check_in_time']}, 60000]},
+            0
+        ]}}
+        group['wait_time_count'] = {'$sum': {'$cond': [has_wait, 1, 0]}}
+
+        results = []
+        seen = []
+        now = datetime.utcnow()
+        for row in appointments.aggregate([{'$match': match}, {'$group': group}]):
+            dept = row.pop('_id')
+            seen.append(dept)
+            row['last_updated'] = now
+            previous = queue_status.find_one_and_update(
+                {'department': dept, 'date': date},
+                {'$set': row},
+                upsert=True
+            )
+            counters = list(STATUS_COUNTERS.values()) + ['wait_time_count']
+            if any((previous or {}).get(field, 0) != row[field] for field in counters):
+                queue_status.update_one({'department': dept, 'date': date}, {'$inc': {'version': 1}})
+                # Let dashboards of this department pick up the corrected numbers
+                EventBus.publish('queue', [f'department:{dept}'], {'department': dept, 'date': date})
+            row.update({'department': dept, 'date': date})
+            results.append(QueueManager._with_derived(row))
+
+        # Departments that had activity but no longer have any appointments in a counted state
+        if not department or department not in seen:
+            reset = {field: 0 for field in STATUS_COUNTERS.values()}
+            reset.update({'wait_time_sum': 0, 'wait_time_count': 0, 'last_updated': now})
+            # Only departments whose counters actually change get a new version
+            stale = {'date': date, 'department': department or {'$nin': seen},
+                     '$or': [{field: {'$ne': 0}} for field in list(STATUS_COUNTERS.values()) + ['wait_time_count']]}
+            stale_departments = queue_status.distinct('department', stale)
+            if stale_departments:
+                queue_status.update_many(
+                    {'date': date, 'department': {'$in': stale_departments}},
+                    {'$set': reset, '$inc': {'version': 1}}
+                )
+                for dept in stale_departments:
+                    EventBus.publish('queue', [f'department:{dept}'], {'department': dept, 'date': date})
+
+        return results
+
+    @staticmethod
+    def update_department_status(department):
+        """Update the queue status for a department."""
+        results = QueueManager.reconcile(department=department)
+        if results:
+            return results[0]
+        return QueueManager._with_derived({
+            'department': department,
+            'checked_in_count': 0,
+            'in_progress_count': 0,
+            'completed_count': 0
+        })
+
     @staticmethod
     def get_department_status(department=None):
         """Get the current queue status for a department or all departments."""
+        today = QueueManager._today()
         if department:
-            return queue_status.find_one({'department': department})
+            return QueueManager._with_derived(
+                queue_status.find_one({'department': department, 'date': today})
+            )
         else:
-            return list(queue_status.find())
-    
+            return [QueueManager._with_derived(s) for s in queue_status.find({'date': today})]
+
     @staticmethod
     def check_in_patient(appointment_id):
         """Check in a patient for their appointment."""
-        # Update appointment status
-        appointments.update_one(
-            {'_id': ObjectId(appointment_id)},
+        check_in_time = datetime.utcnow()
+
+        # Only a scheduled appointment can move into the queue
+        appointment = appointments.find_one_and_update(
+            {'_id': ObjectId(appointment_id), 'status': 'scheduled'},
             {
                 '$set': {
                     'status': 'checked-in',
-                    'check_in_time': datetime.utcnow()
+                    'check_in_time': check_in_time
                 }
-            }
+            },
+            return_document=ReturnDocument.BEFORE
         )
-        
-        # Get appointment details
-        appointment = appointments.find_one({'_id': ObjectId(appointment_id)})
-        
-        # Update queue status for this department
-        QueueManager.update_department_status(appointment['department'])
-        
+
+        if appointment:
+            etas = QueueManager.record_transition(appointment, 'checked-in', check_in_time)
+            if etas and str(appointment['_id']) in etas:
+                return etas[str(appointment['_id'])]
+        else:
+            appointment = appointments.find_one({'_id': ObjectId(appointment_id)})
+            if not appointment:
+                return 0
+
         # Calculate and return estimated wait time
-        queue = queue_status.find_one({'department': appointment['department']})
+        queue = QueueManager.get_department_status(appointment['department'])
         if queue:
             return queue['estimated_wait']
-        return 0
+        return 0
@@ -0,0 +1,76 @@
+from . import queue_status
+from config import Config
+from .queue import QueueManager
+from .serialization import to_json_value
+from .versions import ChangeVersions
+from pymongo.errors import PyMongoError
+import threading
+import time
+
+class QueueBoard:
+    """Cached snapshot of today's queue status for every department.
+
+    Backs the public /api/queue_status board. Each worker reads
+    queue_status at most once per ttl seconds however many screens poll it:
+    a single thread refreshes an expired snapshot while the others keep
+    serving the previous one (or, before the first load, wait for it).
+    """
+
+    def __init__(self, ttl=2.0):
+        self.ttl = ttl
+        self.refreshes = 0
+        self._snapshot = None
+        self._expires = 0.0
+        self._refresh_lock = threading.Lock()
+
+    def _fresh(self, snapshot):
+        return (snapshot is not None and time.monotonic() < self._expires
+                and snapshot['date'] == QueueManager._today())
+
+    def _load(self):
+        date = QueueManager._today()
+        departments = {}
+        for status in queue_status.find({'date': date}):
+            departments[status['department']] = to_json_value(QueueManager._with_derived(status))
+        versions = {name: status.get('version', 0) for name, status in departments.items()}
+        return {
+            'date': date,
+            'statuses': list(departments.values()),
+            'departments': departments,
+            'etag': ChangeVersions.token(date, {}, versions),
+            'etags': {name: ChangeVersions.token(date, {}, {name: version})
+                      for name, version in versions.items()}
+        }
+
+    def get(self):
+        """The current snapshot.
+
+        Returns:
+            dict: statuses (list), departments (name -> status), the ETag of
+            the whole board and etags per department
+        """
+        snapshot = self._snapshot
+        if self._fresh(snapshot):
+            return snapshot
+        if snapshot is not None and not self._refresh_lock.acquire(blocking=False):
+            # Another thread is already refreshing; this one is at most one refresh old
+            return snapshot
+        if snapshot is None:
+            self._refresh_lock.acquire()
+        try:
+            if self._fresh(self._snapshot):
+                return self._snapshot
+            try:
+                self._snapshot = self._load()
+                self.refreshes += 1
+            except PyMongoError as e:
+                if self._snapshot is None:
+                    raise
+                # Keep the board up on stale data rather than failing every screen
+                print(f"Error refreshing queue board: {str(e)}")
+            self._expires = time.monotonic() + self.ttl
+            return self._snapshot
+        finally:
+            self._refresh_lock.release()
+
+queue_board = QueueBoard(ttl=Config.QUEUE_BOARD_TTL)
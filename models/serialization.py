@@ -0,0 +1,75 @@
+"""Conversion of MongoDB documents into JSON-ready values.
+
+A Schema names the fields that need more than the generic BSON handling
+(ObjectId -> str, datetime -> ISO 8601) and converts a whole document in
+one pass over its keys, optionally keeping only the requested fields.
+"""
+from bson import ObjectId, Decimal128
+from datetime import date, datetime
+from uuid import UUID
+
+def to_json_value(value):
+    """Convert a BSON value (recursively) to something json.dumps accepts."""
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, dict):
+        return {key: to_json_value(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple, set)):
+        return [to_json_value(item) for item in value]
+    if isinstance(value, (Decimal128, UUID)):
+        return str(value)
+    return value
+
+def parse_fields(value):
+    """The set of fields named in a comma-separated ?fields= argument, or None for all."""
+    if not value:
+        return None
+    fields = {field.strip() for field in value.split(',') if field.strip()}
+    return fields or None
+
+class Schema:
+    """Field-specific converters and defaults for one kind of document."""
+
+    def __init__(self, converters=None, defaults=None):
+        self.converters = converters or {}
+        self.defaults = defaults or {}
+
+    def dump(self, doc, only=None):
+        """Return a JSON-ready copy of doc.
+
+        Args:
+            doc: The document to convert
+            only: Optional collection of field names to keep
+        """
+        converters = self.converters
+        result = {}
+        for key, value in doc.items():
+            if only is not None and key not in only:
+                continue
+            converter = converters.get(key)
+            result[key] = converter(value) if converter else to_json_value(value)
+        for key, default in self.defaults.items():
+            if key not in result and (only is None or key in only):
+                result[key] = default
+        return result
+
+    def dump_many(self, docs, only=None):
+        return [self.dump(doc, only) for doc in docs]
+
+def _day(value):
+    # Appointment dates are stored as YYYY-MM-DD; older documents used datetimes
+    return value.strftime('%Y-%m-%d') if isinstance(value, datetime) else value
+
+APPOINTMENT_SCHEMA = Schema(
+    converters={
+        'date': _day,
+        'priority': lambda value: int(value or 0)
+    },
+    defaults={
+        'priority': 0,
+        'estimated_wait_time': None,
+        'reason': ''
+    }
+)
@@ -0,0 +1,16 @@
+"""Latency sampling helpers shared by the worker pools and the load tools."""
+from collections import deque
+
+# Latest observations kept for a component's reported percentiles
+SAMPLE_SIZE = 1000
+
+def recent_samples():
+    """A buffer keeping the latest SAMPLE_SIZE observations of one quantity."""
+    return deque(maxlen=SAMPLE_SIZE)
+
+def percentile(samples, fraction):
+    """Nearest-rank percentile of samples, or None if there are none."""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
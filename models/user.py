@@ -1,13 +1,86 @@
 from . import users
-import bcrypt
+from .appointment import Appointment
+from .versions import ChangeVersions
+from .passwords import password_hasher
+from config import Config
+from bson import ObjectId
+from bson.errors import InvalidId
+from collections import OrderedDict
+import threading
+import time
 from datetime import datetime
 
+class UserIdentity:
+    """The logged-in user as Flask-Login sees it."""
+    __slots__ = ('id', 'email', 'name', 'role')
+
+    is_authenticated = True
+    is_active = True
+    is_anonymous = False
+
+    def __init__(self, id, email, name, role):
+        self.id = str(id)
+        self.email = email
+        self.name = name
+        self.role = role
+
+    def get_id(self):
+        return self.id
+
+class IdentityCache:
+    """Bounded LRU cache of UserIdentity objects with a time-to-live.
+
+    The TTL bounds how long another worker's profile change can go
+    unnoticed; changes made through User are invalidated immediately.
+    """
+
+    def __init__(self, maxsize=10000, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            identity, expires = entry
+            if expires < time.monotonic():
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return identity
+
+    def put(self, user_id, identity):
+        with self._lock:
+            self._entries[user_id] = (identity, time.monotonic() + self.ttl)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(str(user_id), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+identity_cache = IdentityCache(
+    maxsize=Config.USER_CACHE_SIZE,
+    ttl=Config.USER_CACHE_TTL
+)
+
 class User:
     @staticmethod
     def create_user(email, password, name, role='patient', phone=None, specialization=None):
-        """Create a new user."""
-        salt = bcrypt.gensalt()
-        hashed_pw = bcrypt.hashpw(password.encode('utf-8'), salt)
+        """Create a new user.
+
+        Raises:
+            PasswordHasherBusy: The password hashing queue is full
+        """
+        hashed_pw = password_hasher.hash(password)
         
         user = {
             'email': email,
@@ -25,6 +98,43 @@ class User:
         result = users.insert_one(user)
         return result.inserted_id
     
+    @staticmethod
+    def identity_from_document(user):
+        """Build (and cache) the login identity for a user document."""
+        identity = UserIdentity(user['_id'], user['email'], user['name'], user['role'])
+        identity_cache.put(identity.id, identity)
+        return identity
+    
+    @staticmethod
+    def load_identity(user_id):
+        """Get the login identity for a user ID, usually without a database call."""
+        identity = identity_cache.get(user_id)
+        if identity is not None:
+            return identity
+        try:
+            user = users.find_one(
+                {'_id': ObjectId(user_id)},
+                {'email': 1, 'name': 1, 'role': 1}
+            )
+        except InvalidId:
+            return None
+        if not user:
+            return None
+        return User.identity_from_document(user)
+    
+    @staticmethod
+    def update_user(user_id, update_data):
+        """Update a user's profile fields, drop their cached identity and
+        refresh the name and phone copied onto their appointments."""
+        if isinstance(user_id, str):
+            user_id = ObjectId(user_id)
+        result = users.update_one({'_id': user_id}, {'$set': update_data})
+        identity_cache.invalidate(user_id)
+        if result.modified_count:
+            Appointment.sync_user_snapshot(user_id, update_data)
+            ChangeVersions.bump([f"patient:{user_id}", f"doctor:{user_id}"])
+        return result.modified_count > 0
+    
     @staticmethod
     def get_by_email(email):
         """Get user by email."""
@@ -32,10 +142,23 @@ class User:
     
     @staticmethod
     def verify_password(user, password):
-        """Verify password."""
-        if not user or 'password' not in user:
+        """Verify password, upgrading the stored hash if BCRYPT_ROUNDS has changed.
+
+        Raises:
+            PasswordHasherBusy: The password hashing queue is full
+        """
+        if not user or 'password' not in user or not password:
+            return False
+        stored = user['password']
+        if not password_hasher.verify(password, stored):
             return False
-        return bcrypt.checkpw(password.encode('utf-8'), user['password'])
+        if password_hasher.needs_rehash(stored):
+            # Only replace the hash we checked, in case the password changed meanwhile
+            password_hasher.rehash_later(password, lambda hashed: users.update_one(
+                {'_id': user['_id'], 'password': stored},
+                {'$set': {'password': hashed}}
+            ))
+        return True
         
     @staticmethod
     def get_doctors(specialization=None):
@@ -43,4 +166,4 @@ class User:
         query = {'role': 'doctor', 'active': True}
         if specialization:
             query['specialization'] = specialization
-        return list(users.find(query, {'password': 0}))
+        return list(users.find(query, {'password': 0}))
@@ -0,0 +1,87 @@
+from . import versions, queue_status
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+import hashlib
+
+class ChangeVersions:
+    """Counters bumped on every change to a patient's or doctor's appointments.
+
+    Keys follow the EventBus topics (patient:<id>, doctor:<id>); department
+    queues already carry a version on their queue_status document. Together
+    they give the dashboard APIs an ETag without reading any appointments.
+    """
+
+    @staticmethod
+    def keys_for(appointment):
+        """Version keys of the patient and doctor of an appointment."""
+        keys = []
+        for role in ('patient', 'doctor'):
+            if appointment.get(f'{role}_id'):
+                keys.append(f"{role}:{appointment[f'{role}_id']}")
+        return keys
+
+    @staticmethod
+    def bump(keys):
+        """Invalidate the ETags of these keys after a change.
+
+        Best effort: the change itself is already written, so a failure is
+        logged rather than reported to the caller as a failed change.
+        """
+        keys = list(dict.fromkeys(keys))
+        if not keys:
+            return
+        try:
+            versions.bulk_write([
+                UpdateOne({'_id': key}, {'$inc': {'version': 1}}, upsert=True)
+                for key in keys
+            ], ordered=False)
+        except PyMongoError as e:
+            print(f"Error bumping change versions: {str(e)}")
+
+    @staticmethod
+    def get(keys):
+        """Mapping of key -> version; keys never bumped are left out."""
+        return {doc['_id']: doc['version'] for doc in versions.find({'_id': {'$in': list(keys)}})}
+
+    @staticmethod
+    def queue_versions(date, departments=None):
+        """Mapping of department -> queue_status version for one day.
+
+        Args:
+            date: The day (YYYY-MM-DD)
+            departments: Only these departments; None for every department
+        """
+        query = {'date': date}
+        if departments is not None:
+            if not departments:
+                return {}
+            query['department'] = {'$in': list(departments)}
+        return {
+            status['department']: status.get('version', 0)
+            for status in queue_status.find(query, {'department': 1, 'version': 1})
+        }
+
+    @staticmethod
+    def etag(date, keys=(), departments=None):
+        """Token that changes whenever a response built from these versions would.
+
+        Args:
+            date: The day the response is for; lists shift when it changes
+            keys: Patient/doctor version keys the response depends on
+            departments: The queues the response shows; None for every
+                department. A check-in elsewhere in the clinic then leaves
+                the token alone.
+        """
+        return ChangeVersions.token(
+            date,
+            ChangeVersions.get(keys) if keys else {},
+            ChangeVersions.queue_versions(date, departments)
+        )
+
+    @staticmethod
+    def token(date, key_versions, queue_versions):
+        """Hash versions already loaded into the ETag format used by etag()."""
+        parts = [date]
+        parts += [f"{key}={version}" for key, version in sorted(key_versions.items())]
+        parts += [f"department:{dept}={version}" for dept, version in sorted(queue_versions.items())]
+        return hashlib.sha1('|'.join(parts).encode()).hexdigest()
@@ -0,0 +1,140 @@
+from . import doctor_stats, appointments
+from datetime import datetime
+from bson import ObjectId
+from pymongo import ReturnDocument, UpdateOne
+
+# Weight of the newest consultation in the running mean
+EWMA_ALPHA = 0.2
+
+# Consultation length assumed until a doctor has some history (minutes)
+DEFAULT_CONSULT_MINUTES = 15
+
+# One-minute histogram buckets; anything longer lands in the last one
+HISTOGRAM_BUCKETS = 180
+
+class WaitTimePredictor:
+    """Per-doctor consultation statistics and patient ETAs.
+
+    Every finished consultation updates an exponentially weighted mean and
+    a one-minute histogram (the percentile sketch) on the doctor's
+    doctor_stats document in a single atomic update, so statistics from
+    all workers merge without rescanning appointments.
+    """
+
+    @staticmethod
+    def _doctor_id(doctor_id):
+        if isinstance(doctor_id, str):
+            return ObjectId(doctor_id)
+        return doctor_id
+
+    @staticmethod
+    def record_consultation(doctor_id, minutes):
+        """Fold one finished consultation into the doctor's statistics.
+
+        Returns:
+            dict: The updated statistics document
+        """
+        minutes = max(float(minutes), 0.0)
+        bucket = f"histogram.m{min(int(minutes), HISTOGRAM_BUCKETS - 1)}"
+        return doctor_stats.find_one_and_update(
+            {'doctor_id': WaitTimePredictor._doctor_id(doctor_id)},
+            [{'$set': {
+                'ewma_minutes': {'$cond': [
+                    {'$gt': [{'$ifNull': ['$count', 0]}, 0]},
+                    {'$add': [
+                        EWMA_ALPHA * minutes,
+                        {'$multiply': [1 - EWMA_ALPHA, '$ewma_minutes']}
+                    ]},
+                    minutes
+                ]},
+                'count': {'$add': [{'$ifNull': ['$count', 0]}, 1]},
+                bucket: {'$add': [{'$ifNull': [f'${bucket}', 0]}, 1]},
+                'current_start': None,
+                'last_updated': datetime.utcnow()
+            }}],
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+
+    @staticmethod
+    def set_current_consult(doctor_id, started_at):
+        """Record when the doctor's current consultation began (None when free)."""
+        return doctor_stats.find_one_and_update(
+            {'doctor_id': WaitTimePredictor._doctor_id(doctor_id)},
+            {'$set': {'current_start': started_at}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+
+    @staticmethod
+    def percentile(stats, fraction):
+        """Approximate a consultation length percentile from the histogram."""
+        histogram = (stats or {}).get('histogram') or {}
+        total = sum(histogram.values())
+        if not total:
+            return None
+        target = fraction * total
+        seen = 0
+        for bucket in sorted(histogram, key=lambda b: int(b[1:])):
+            seen += histogram[bucket]
+            if seen >= target:
+                # Bucket midpoint
+                return int(bucket[1:]) + 0.5
+        return HISTOGRAM_BUCKETS - 0.5
+
+    @staticmethod
+    def get_stats(doctor_id):
+        """Summary statistics for a doctor's consultations."""
+        stats = doctor_stats.find_one({'doctor_id': WaitTimePredictor._doctor_id(doctor_id)})
+        return {
+            'count': (stats or {}).get('count', 0),
+            'mean_minutes': (stats or {}).get('ewma_minutes') or DEFAULT_CONSULT_MINUTES,
+            'p50_minutes': WaitTimePredictor.percentile(stats, 0.5),
+            'p90_minutes': WaitTimePredictor.percentile(stats, 0.9),
+            'in_consultation': bool((stats or {}).get('current_start'))
+        }
+
+    @staticmethod
+    def _remaining_minutes(stats, mean, now):
+        """Expected time left in the consultation currently under way."""
+        started = (stats or {}).get('current_start')
+        if not started:
+            return 0
+        elapsed = (now - started).total_seconds() / 60
+        if elapsed < mean:
+            return mean - elapsed
+        # Overrunning: expect it to end near this doctor's long tail
+        p90 = WaitTimePredictor.percentile(stats, 0.9) or mean
+        return max(p90 - elapsed, mean / 4)
+
+    @staticmethod
+    def update_etas(doctor_id, waiting_ids, stats=None, now=None):
+        """Store an ETA on every waiting appointment of a doctor.
+
+        Args:
+            doctor_id: The ID of the doctor
+            waiting_ids: Appointment IDs in queue order
+            stats: The doctor's statistics document if already loaded
+            now: Reference time, defaults to now (UTC)
+
+        Returns:
+            dict: Mapping of appointment ID -> estimated wait in minutes
+        """
+        if not waiting_ids:
+            return {}
+        now = now or datetime.utcnow()
+        if stats is None:
+            stats = doctor_stats.find_one({'doctor_id': WaitTimePredictor._doctor_id(doctor_id)})
+        mean = (stats or {}).get('ewma_minutes') or DEFAULT_CONSULT_MINUTES
+        remaining = WaitTimePredictor._remaining_minutes(stats, mean, now)
+
+        etas = {}
+        operations = []
+        for ahead, appointment_id in enumerate(waiting_ids):
+            etas[appointment_id] = int(round(remaining + ahead * mean))
+            operations.append(UpdateOne(
+                {'_id': ObjectId(appointment_id), 'status': 'checked-in'},
+                {'$set': {'estimated_wait_time': etas[appointment_id]}}
+            ))
+        appointments.bulk_write(operations, ordered=False)
+        return etas
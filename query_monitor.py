@@ -0,0 +1,129 @@
+"""Per-request MongoDB command counts and N+1 detection.
+
+QueryMonitor is a pymongo command listener. While a request is being
+handled it counts the commands the request thread sends, adds up their
+server time and groups them by shape: the command, the collection and
+the filter with every value replaced by ``?``. A request that sends more
+than QUERY_BUDGET commands, or repeats one shape more than
+QUERY_REPEAT_LIMIT times (a query inside a loop), is logged as a warning
+and answered with an X-Query-Warning header.
+"""
+from collections import Counter
+from contextvars import ContextVar
+from flask import request
+from pymongo import monitoring
+
+# Commands that are part of reading one result rather than new queries
+_FOLLOW_UP_COMMANDS = {'getMore', 'killCursors', 'endSessions'}
+
+# Where each command keeps its filter
+_FILTER_FIELDS = {
+    'find': 'filter', 'count': 'query', 'distinct': 'query', 'findAndModify': 'query',
+    'aggregate': 'pipeline', 'update': 'updates', 'delete': 'deletes'
+}
+
+_current = ContextVar('request_queries', default=None)
+
+def _shape(value):
+    if isinstance(value, dict):
+        return '{' + ', '.join(f"{key}: {_shape(item)}" for key, item in value.items()) + '}'
+    if isinstance(value, (list, tuple)):
+        if value and all(isinstance(item, dict) for item in value):
+            return '[' + ', '.join(_shape(item) for item in value) + ']'
+        return '[?]'
+    return '?'
+
+def command_shape(command_name, command):
+    """The command name, collection and filter with values blanked out."""
+    collection = command.get(command_name)
+    field = _FILTER_FIELDS.get(command_name)
+    criteria = command.get(field) if field else None
+    if command_name in ('update', 'delete') and criteria:
+        # Bulk statements: the filter of each statement, once per distinct shape
+        criteria = sorted({_shape(statement.get('q', {})) for statement in criteria})
+        return f"{command_name} {collection} {' | '.join(criteria)}"
+    if criteria is None:
+        return f"{command_name} {collection}"
+    return f"{command_name} {collection} {_shape(criteria)}"
+
+class RequestQueries:
+    """Commands sent while handling one request."""
+    __slots__ = ('count', 'duration_micros', 'shapes')
+
+    def __init__(self):
+        self.count = 0
+        self.duration_micros = 0
+        self.shapes = Counter()
+
+class QueryMonitor(monitoring.CommandListener):
+    """Flag requests that send too many commands or repeat one query shape.
+
+    Register it with pymongo before the first client is created, then
+    call init_app so each request gets its own tally.
+    """
+
+    def __init__(self, app=None, budget=25, repeat_limit=5):
+        self.budget = budget
+        self.repeat_limit = repeat_limit
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.budget = app.config.get('QUERY_BUDGET', self.budget)
+        self.repeat_limit = app.config.get('QUERY_REPEAT_LIMIT', self.repeat_limit)
+        self.logger = app.logger
+        app.before_request(self._before)
+        app.after_request(self._after)
+        app.teardown_request(self._teardown)
+        app.extensions['query_monitor'] = self
+
+    # Command events arrive on the thread that sent the command, so only
+    # commands sent by a request thread find a tally here
+    def started(self, event):
+        queries = _current.get()
+        if queries is None or event.command_name in _FOLLOW_UP_COMMANDS:
+            return
+        queries.count += 1
+        queries.shapes[command_shape(event.command_name, event.command)] += 1
+
+    def succeeded(self, event):
+        queries = _current.get()
+        if queries is not None:
+            queries.duration_micros += event.duration_micros
+
+    def failed(self, event):
+        self.succeeded(event)
+
+    def _before(self):
+        _current.set(RequestQueries())
+
+    def problems(self, queries):
+        """Why a request's queries look like an N+1 pattern; empty when they do not."""
+        found = []
+        if queries.count > self.budget:
+            found.append(f"{queries.count} queries (budget {self.budget})")
+        for shape, times in queries.shapes.most_common():
+            if times <= self.repeat_limit:
+                break
+            found.append(f"{shape} x{times}")
+        return found
+
+    def _after(self, response):
+        queries = _current.get()
+        if queries is None:
+            return response
+        found = self.problems(queries)
+        if found:
+            rule = request.url_rule
+            self.logger.warning(
+                "Possible N+1 in %s %s: %d queries, %.1f ms in MongoDB; %s",
+                request.method, rule.rule if rule is not None else request.path,
+                queries.count, queries.duration_micros / 1000, '; '.join(found)
+            )
+            # Header values must stay on one line and within proxy limits
+            response.headers['X-Query-Warning'] = '; '.join(found)[:512]
+        return response
+
+    def _teardown(self, error=None):
+        # Worker threads are reused; never let a tally outlive its request
+        _current.set(None)
@@ -0,0 +1,156 @@
+"""Standalone scheduler for the healthcare app's background jobs.
+
+    python scheduler.py              # run a scheduler; start a second one for failover
+    python scheduler.py --list       # show the stored jobs and who holds the lease
+
+Web workers never start a scheduler. Jobs (see jobs.py) are kept in a
+MongoDB job store, so their next run times survive restarts, and only
+the process holding the lease in the locks collection runs them. The
+others stand by and take over once the lease expires, so however many
+web workers or scheduler processes are running, each job runs once.
+"""
+from config import Config
+from models import db, get_client, get_database
+from jobs import JOBS
+from apscheduler.jobstores.mongodb import MongoDBJobStore
+from apscheduler.schedulers.background import BackgroundScheduler
+from datetime import datetime, timedelta
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, PyMongoError
+import argparse
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import uuid
+
+JOBS_COLLECTION = 'scheduler_jobs'
+LEASE_NAME = 'scheduler'
+
+class LeaderLease:
+    """A lease on one document in the locks collection.
+
+    Whoever holds an unexpired lease is the leader; holding it means
+    renewing it well within ttl seconds.
+    """
+
+    def __init__(self, name=LEASE_NAME, ttl=30):
+        self.name = name
+        self.ttl = ttl
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self._held_until = 0.0
+
+    def acquire(self):
+        """Take the lease if it is free or expired, or renew it if already ours.
+
+        Returns:
+            bool: Whether this process holds the lease
+        """
+        now = datetime.utcnow()
+        try:
+            db.locks.find_one_and_update(
+                {'_id': self.name, '$or': [{'owner': self.owner}, {'expires_at': {'$lt': now}}]},
+                {'$set': {'owner': self.owner, 'expires_at': now + timedelta(seconds=self.ttl),
+                          'renewed_at': now}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # The filter missed an existing lease, so someone else holds it
+            return False
+        except PyMongoError as e:
+            print(f"Error renewing scheduler lease: {str(e)}")
+            # Nobody else can take it before it expires
+            return time.monotonic() < self._held_until
+        self._held_until = time.monotonic() + self.ttl
+        return True
+
+    def release(self):
+        try:
+            db.locks.delete_one({'_id': self.name, 'owner': self.owner})
+        except PyMongoError as e:
+            print(f"Error releasing scheduler lease: {str(e)}")
+        self._held_until = 0.0
+
+def build_scheduler():
+    return BackgroundScheduler(
+        jobstores={'default': MongoDBJobStore(
+            database=get_database().name, collection=JOBS_COLLECTION, client=get_client()
+        )},
+        # A run missed during a failover happens once, late, rather than not at all or twice
+        job_defaults={'coalesce': True, 'max_instances': 1, 'misfire_grace_time': 5 * 60}
+    )
+
+def sync_jobs(scheduler):
+    """Add jobs.JOBS to the store, keeping the stored next run time of unchanged jobs."""
+    for job_id, func, trigger, trigger_args in JOBS:
+        existing = scheduler.get_job(job_id)
+        scheduler.add_job(func, trigger, id=job_id, replace_existing=True, **trigger_args)
+        if existing is not None:
+            job = scheduler.get_job(job_id)
+            if str(job.trigger) == str(existing.trigger) and existing.next_run_time:
+                job.modify(next_run_time=existing.next_run_time)
+    # Drop jobs that were removed from JOBS
+    wanted = {job_id for job_id, _, _, _ in JOBS}
+    for job in scheduler.get_jobs():
+        if job.id not in wanted:
+            job.remove()
+
+def run(lease_seconds):
+    lease = LeaderLease(ttl=lease_seconds)
+    stop = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: stop.set())
+
+    scheduler = None
+    print(f"Scheduler {lease.owner} waiting for the lease")
+    try:
+        while not stop.is_set():
+            if lease.acquire():
+                if scheduler is None:
+                    scheduler = build_scheduler()
+                    scheduler.start(paused=True)
+                    sync_jobs(scheduler)
+                    scheduler.resume()
+                    print(f"Scheduler {lease.owner} is the leader")
+            elif scheduler is not None:
+                scheduler.shutdown(wait=False)
+                scheduler = None
+                print(f"Scheduler {lease.owner} lost the lease; standing by")
+            # Renew well before the lease can expire
+            stop.wait(lease_seconds / 3)
+    finally:
+        if scheduler is not None:
+            scheduler.shutdown()
+            lease.release()
+
+def list_jobs():
+    holder = db.locks.find_one({'_id': LEASE_NAME})
+    if holder:
+        print(f"Lease held by {holder['owner']} until {holder['expires_at']:%Y-%m-%d %H:%M:%S} UTC")
+    else:
+        print('Lease not held')
+    scheduler = build_scheduler()
+    scheduler.start(paused=True)
+    for job in scheduler.get_jobs():
+        print(f"{job.id}: {job.trigger}, next run {job.next_run_time}")
+    scheduler.shutdown(wait=False)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the background job scheduler')
+    parser.add_argument('--lease-seconds', type=float,
+                        default=Config.SCHEDULER_LEASE_SECONDS,
+                        help='how long a silent leader keeps the lease')
+    parser.add_argument('--list', action='store_true', help='show stored jobs and the lease holder')
+    args = parser.parse_args(argv)
+
+    if args.list:
+        list_jobs()
+    else:
+        run(args.lease_seconds)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,82 @@
+// Live dashboard updates: refresh on server-sent events, poll only as a fallback
+function liveUpdates(streamUrl, refresh, fallbackMs) {
+    // While the stream is open, still refresh now and then in case an event was missed
+    const connectedMs = Math.max(fallbackMs, 5 * 60 * 1000);
+    let pollTimer = setInterval(refresh, fallbackMs);
+    if (!window.EventSource) {
+        return;
+    }
+
+    function pollEvery(ms) {
+        clearInterval(pollTimer);
+        pollTimer = setInterval(refresh, ms);
+    }
+
+    let pending = null;
+    // Collapse a burst of events (e.g. a busy check-in desk) into one refresh
+    function scheduleRefresh() {
+        if (!pending) {
+            pending = setTimeout(function() {
+                pending = null;
+                refresh();
+            }, 500);
+        }
+    }
+
+    let connected = false;
+    const source = new EventSource(streamUrl);
+    source.onopen = function() {
+        connected = true;
+        pollEvery(connectedMs);
+        // Catch up on anything missed while disconnected
+        refresh();
+    };
+    source.onerror = function() {
+        // The browser reconnects on its own; keep the page fresh meanwhile
+        if (connected) {
+            connected = false;
+            pollEvery(fallbackMs);
+        }
+    };
+    source.addEventListener('appointment', scheduleRefresh);
+    source.addEventListener('queue', scheduleRefresh);
+}
+
+// "Load more" paging over a history API answering {appointments, next_cursor}.
+// Returns a function that loads the next page; call it once for the first page.
+function pagedList(url, tbody, button, renderRow, emptyMessage) {
+    let cursor = null;
+    let started = false;
+
+    function loadMore() {
+        button.disabled = true;
+        const pageUrl = cursor ? `${url}?cursor=${encodeURIComponent(cursor)}` : url;
+        return fetch(pageUrl)
+            .then(response => {
+                if (!response.ok) {
+                    throw new Error(`HTTP error! status: ${response.status}`);
+                }
+                return response.json();
+            })
+            .then(data => {
+                if (!started) {
+                    tbody.innerHTML = '';
+                    started = true;
+                }
+                tbody.insertAdjacentHTML('beforeend', data.appointments.map(renderRow).join(''));
+                if (!tbody.children.length) {
+                    const columns = tbody.closest('table').querySelectorAll('thead th').length;
+                    tbody.innerHTML = `<tr><td colspan="${columns}" class="text-muted">${emptyMessage}</td></tr>`;
+                }
+                cursor = data.next_cursor;
+                button.classList.toggle('d-none', !cursor);
+            })
+            .catch(error => console.error('Error loading history:', error))
+            .finally(() => {
+                button.disabled = false;
+            });
+    }
+
+    button.addEventListener('click', loadMore);
+    return loadMore;
+}